@@ -0,0 +1,49 @@
+import json
+import sys
+import time
+
+from geminitgbot import format_translation, parse_translation, parse_translation_json, parse_translation_regex
+
+# 对比 Gemini 回复的解析耗时和失败率
+# 用法：python bench_parse.py [回复语料.jsonl] [重复次数]
+# 语料每行一个 JSON 对象，"text" 字段为模型返回的原始文本
+CORPUS_PATH = sys.argv[1] if len(sys.argv) > 1 else 'bench_data/translation_responses.jsonl'
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+PARSERS = [
+    ('JSON 单次解析', parse_translation_json),
+    ('正则解析（旧）', parse_translation_regex),
+    ('JSON + 正则回退', parse_translation),
+    ('解析并格式化回复', lambda text: format_translation(text)[1]),
+]
+
+
+def load_corpus(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line)['text'] for line in f if line.strip()]
+
+
+def failed(result):
+    if result is None:
+        return True
+    if isinstance(result, str):
+        return False
+    return not result.translation
+
+
+def main():
+    corpus = load_corpus(CORPUS_PATH)
+    print(f"语料 {len(corpus)} 条，每个解析器重复 {ROUNDS} 轮\n")
+    print(f"{'解析器':<16}{'平均耗时(µs/条)':>16}{'失败率':>10}")
+    for name, parser in PARSERS:
+        failures = sum(1 for text in corpus if failed(parser(text)))
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            for text in corpus:
+                parser(text)
+        per_item = (time.perf_counter() - start) / (ROUNDS * len(corpus)) * 1e6
+        print(f"{name:<16}{per_item:>16.2f}{failures * 100 / len(corpus):>9.1f}%")
+
+
+if __name__ == '__main__':
+    main()
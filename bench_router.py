@@ -0,0 +1,34 @@
+import sys
+import time
+
+from geminitgbot import ADMIN_ACTIONS, SUBMENU_LABELS, USER_ACTIONS, resolve_route
+
+# 测量文字消息路由（按钮查表 + 会话状态）的单次分发耗时
+# 用法：python bench_router.py [重复次数]
+ROUNDS = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+CASES = [
+    ('用户按钮', False, None, '👤 我的资料'),
+    ('用户子菜单', False, None, next(iter(SUBMENU_LABELS))),
+    ('用户翻译文本', False, None, '你好，今天天气怎么样'),
+    ('用户反馈输入', False, 'feedback', '希望增加语音翻译'),
+    ('管理员按钮', True, None, '📊 查看统计'),
+    ('管理员设置次数输入', True, 'admin_set_limit', '123456 50'),
+    ('管理员无效操作', True, None, '随便输入'),
+]
+
+
+def main():
+    print(f"用户按钮 {len(USER_ACTIONS)} 个，管理员按钮 {len(ADMIN_ACTIONS)} 个，每种情况重复 {ROUNDS} 次\n")
+    print(f"{'情况':<14}{'处理函数':<24}{'平均耗时(ns/次)':>16}")
+    for name, is_admin, state, text in CASES:
+        action = resolve_route(is_admin, state, text)
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            resolve_route(is_admin, state, text)
+        per_call = (time.perf_counter() - start) / ROUNDS * 1e9
+        print(f"{name:<14}{action.__name__:<24}{per_call:>16.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,29 @@
+import time
+STARTUP_STARTED = time.perf_counter()  # 启动计时起点，用于启动耗时报告
 import telegram
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters as Filters, CallbackContext
-from telegram.ext.filters import MessageFilter
-import google.generativeai as genai
+from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.request import HTTPXRequest
+from telegram.ext import ApplicationBuilder, BaseUpdateProcessor, PicklePersistence, CommandHandler, MessageHandler, CallbackQueryHandler, filters as Filters, CallbackContext
+from google.api_core import exceptions as google_exceptions
 import re
-import time
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from aiohttp import web
 import os
 import json
 import base64
 import random
 import logging
 import datetime
+import threading
+import sqlite3
+import hashlib
+import unicodedata
+from collections import OrderedDict, deque, namedtuple
+import asyncio
+import functools
+import signal
+from concurrent.futures import ThreadPoolExecutor
+# google.generativeai、googleapiclient 等较重的 SDK 在首次使用时才导入（见 GeminiClient、get_sheets_service），
+# 启动后由 warm_up_clients 在后台预热，不阻塞开始接收更新
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
@@ -23,12 +34,8 @@ GOOGLE_CREDENTIALS_BASE64 = os.environ.get('GOOGLE_CREDENTIALS_BASE64')
 GROUP_ID_STR = os.environ.get('TELEGRAM_GROUP_ID')
 SHEET_ID = os.environ.get('GOOGLE_SHEET_ID')  # 显式读取 SHEET_ID 环境变量
 SHEET_RANGE = os.environ.get('SHEET_RANGE')  # 显式读取 SHEET_RANGE 环境变量
-credentials_json_str = base64.b64decode(GOOGLE_CREDENTIALS_BASE64).decode('utf-8') if GOOGLE_CREDENTIALS_BASE64 else None
-CREDENTIALS = json.loads(credentials_json_str) if credentials_json_str else None
-if CREDENTIALS:
-    logging.info("成功加载凭据。")
-else:
-    logging.warning("GOOGLE_CREDENTIALS 未加载。")  # 确保将获取到的 GROUP_ID 转换为整数
+if not GOOGLE_CREDENTIALS_BASE64:
+    logging.warning("GOOGLE_CREDENTIALS 未加载。")  # 凭据在首次访问 Google Sheets 时才解码
 try:
     GROUP_ID = int(GROUP_ID_STR) if GROUP_ID_STR else None
 except (ValueError, TypeError):
@@ -40,230 +47,1457 @@ API_CONFIGS = [
     {'api_key': GEMINI_API_KEY_3}
 ]
 GEMINI_MODELS = ['gemini-2.0-flash-exp-image-generation', 'gemini-2.0-pro', 'gemma-3-27b-it']
-current_api_index = 0
-current_model_index = 0
-user_daily_limit_status = {}
-user_remaining_days_status = {}
-sent_vocabulary = []
 user_translation_status = {}
 main_keyboard_buttons = ['账号出售', '网站搭建', 'AI创业', '网赚资源', '常用工具', '技术指导']
 ADMIN_IDS = [7137722967]  # 替换为你的 Telegram ID
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # 例如 https://<app>.herokuapp.com，设置后使用 webhook 模式，否则使用长轮询
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')  # webhook 路径和 Telegram secret_token
+FAST_START = os.environ.get('FAST_START', '1') == '1'  # 先开始接收更新，再在后台预热 Gemini 和 Sheets 客户端
+PORT = int(os.environ.get('PORT', '8080'))
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', '16'))  # 同时处理的更新数（不同用户之间并行）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # 延迟直方图分桶（秒）
+LOOP_LAG_INTERVAL = float(os.environ.get('LOOP_LAG_INTERVAL', '0.5'))  # 事件循环延迟采样间隔（秒）
+UPDATE_USER_QUEUE = int(os.environ.get('UPDATE_USER_QUEUE', '5'))  # 每个用户最多排队的更新数，超出后丢弃
+LAO_TZ = datetime.timezone(datetime.timedelta(hours=7))  # 老挝时间
+USER_TABLE_REFRESH_SECONDS = int(os.environ.get('USER_TABLE_REFRESH_SECONDS', '600'))  # 用户表定时刷新间隔
+USER_FIELD_COLUMNS = {'daily_limit': 'C', 'remaining_days': 'D', 'daily_quota': 'F'}  # F 列为每日额度，留空时使用默认值
+DEFAULT_DAILY_LIMIT = int(os.environ.get('DEFAULT_DAILY_LIMIT', '3'))
+DAILY_RESET_RETRY_SECONDS = 300
+HISTORY_SHEET_NAME = 'TranslationHistory'
+HISTORY_KEEP = int(os.environ.get('HISTORY_KEEP', '50'))  # 本地为每位用户保留的最近翻译条数
+HISTORY_PAGE_SIZE = 10
+STATS_PAGE_SIZE = 30  # 用户列表每页条数
+EXPIRING_SOON_DAYS = int(os.environ.get('EXPIRING_SOON_DAYS', '3'))  # 剩余天数不超过该值视为即将到期
+WRITE_FLUSH_INTERVAL = float(os.environ.get('WRITE_FLUSH_INTERVAL', '5'))  # 写回队列刷新间隔（秒）
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', '50'))  # 队列达到该深度时立即刷新
+user_table = {}  # user_id(str) -> 用户信息，'row' 为该用户在 UserStats 中的行号
+user_table_lock = threading.RLock()
+user_table_loaded = False
+SHEETS_HTTP_TIMEOUT = float(os.environ.get('SHEETS_HTTP_TIMEOUT', '30'))
+sheets_credentials = None
+sheets_client_lock = threading.Lock()
+sheets_local = threading.local()  # 每个线程一个 Sheets 客户端
+SHEETS_MAX_WORKERS = int(os.environ.get('SHEETS_MAX_WORKERS', '4'))  # Sheets 线程池大小，同时也是并发上限
+SHEETS_CALL_TIMEOUT = float(os.environ.get('SHEETS_CALL_TIMEOUT', '20'))  # 单次 Sheets 调用超时（秒）
+sheets_executor = ThreadPoolExecutor(max_workers=SHEETS_MAX_WORKERS, thread_name_prefix='sheets')
+sheets_semaphore = asyncio.Semaphore(SHEETS_MAX_WORKERS)
+background_tasks = set()
+GEMINI_KEY_RPM = float(os.environ.get('GEMINI_KEY_RPM', '15'))  # 每个 (key, 模型) 每分钟请求数上限
+GEMINI_KEY_BURST = int(os.environ.get('GEMINI_KEY_BURST', '3'))
+GEMINI_QUOTA_COOLDOWN = float(os.environ.get('GEMINI_QUOTA_COOLDOWN', '60'))  # 429 后冷却时间（秒）
+GEMINI_ERROR_COOLDOWN = float(os.environ.get('GEMINI_ERROR_COOLDOWN', '10'))  # 服务端错误后冷却时间（秒）
+GEMINI_MAX_WAIT = float(os.environ.get('GEMINI_MAX_WAIT', '10'))  # 所有客户端都限流时最多等待（秒）
+GEMINI_MAX_CONCURRENCY = int(os.environ.get('GEMINI_MAX_CONCURRENCY', '8'))  # 同时进行的 Gemini 请求数上限
+GEMINI_TIMEOUT = float(os.environ.get('GEMINI_TIMEOUT', '30'))  # 单次请求硬性截止时间（秒）
+GEMINI_HEDGE = os.environ.get('GEMINI_HEDGE', '1') == '1'  # 慢请求时向另一个 key 发送重复请求
+GEMINI_HEDGE_MIN_DELAY = float(os.environ.get('GEMINI_HEDGE_MIN_DELAY', '2'))
+GEMINI_HEDGE_DEFAULT_DELAY = float(os.environ.get('GEMINI_HEDGE_DEFAULT_DELAY', '6'))  # 延迟样本不足时使用
+inflight_translations = {}  # 缓存键 -> 正在进行的翻译（asyncio.Future）
+singleflight_stats = {'leaders': 0, 'followers': 0}
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', '25'))  # 广播每秒发送条数（Telegram 全局限制约 30 条/秒）
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', '10'))  # 并发发送数
+BROADCAST_MAX_RETRIES = int(os.environ.get('BROADCAST_MAX_RETRIES', '3'))  # 网络错误重试次数
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get('BROADCAST_PROGRESS_INTERVAL', '3'))  # 进度刷新间隔（秒）
+blocked_users = None  # 已屏蔽机器人的用户，首次使用时从本地数据库加载
+VOCAB_CATEGORIES = ['交通', '教育', '日常', '工具', '餐饮', '娱乐', '房产', '汽车', '家用', '旅游', '航天', '婚姻', '情感', '社会', '名词', '动词', '代词', '副词', '形容词', '介词', '连接词', '感叹词', '限定词', '时间', '地点', '称呼', '动物', '植物', '行为', '运动', '单位', '数字', '关系', '身体', '颜色', '人体器官']
+VOCAB_POOL_TARGET = int(os.environ.get('VOCAB_POOL_TARGET', '7'))  # 预先生成并排队的词汇条数
+VOCAB_PRODUCER_INTERVAL = float(os.environ.get('VOCAB_PRODUCER_INTERVAL', '3600'))  # 后台补充词汇的间隔（秒）
+VOCAB_SEEN_MAX = int(os.environ.get('VOCAB_SEEN_MAX', '5000'))  # 去重集合最多保留的条数
+vocab_seen = None  # 已生成过的老挝语词汇（规范化后），首次使用时从本地数据库加载
+TRANSLATION_STREAMING = os.environ.get('TRANSLATION_STREAMING', '1') == '1'  # 边生成边编辑回复消息
+STREAM_EDIT_INTERVAL = float(os.environ.get('STREAM_EDIT_INTERVAL', '1.0'))  # 两次编辑消息的最小间隔（秒）
+FREE_TEXT_MAX_CHARS = 20  # 普通用户单条消息字数上限
+VIP_USER_IDS = {int(value) for value in os.environ.get('VIP_USER_IDS', '').split(',') if value.strip().isdigit()}  # 可使用长文本模式的用户
+LONG_TEXT_MAX_CHARS = int(os.environ.get('LONG_TEXT_MAX_CHARS', '1000'))  # 长文本模式单条消息字数上限
+LONG_TEXT_SEGMENT_CHARS = int(os.environ.get('LONG_TEXT_SEGMENT_CHARS', str(FREE_TEXT_MAX_CHARS)))  # 每段字数上限，每段计一次额度
+LONG_TEXT_BATCH_SEGMENTS = int(os.environ.get('LONG_TEXT_BATCH_SEGMENTS', '8'))  # 每次 Gemini 调用翻译的段数
+TELEGRAM_MESSAGE_LIMIT = 4000  # 单条消息最大字数（Telegram 上限 4096）
+# 对冲请求也占用线程，所以线程数是并发上限的两倍
+gemini_executor = ThreadPoolExecutor(max_workers=GEMINI_MAX_CONCURRENCY * 2, thread_name_prefix='gemini')
+gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+LOCAL_DB_PATH = os.environ.get('LOCAL_DB_PATH', 'bot_state.sqlite3')  # 本地 SQLite 状态文件
+local_db = None
+local_db_lock = threading.RLock()
+# 本地 SQLite 读写都在这个线程中执行，不阻塞事件循环；只用一个线程，同一用户的写入和随后的读取按提交顺序执行
+local_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='local-db')
+PERSISTENCE_PATH = os.environ.get('PERSISTENCE_PATH', 'bot_state.pickle')  # 会话状态、翻译开关和用户表快照
+PERSISTENCE_INTERVAL = float(os.environ.get('PERSISTENCE_INTERVAL', '60'))  # 快照写入磁盘的间隔（秒），期间的修改合并为一次写入
+WARM_STATE_MAX_AGE = float(os.environ.get('WARM_STATE_MAX_AGE', str(6 * 3600)))  # 用户表快照在该时间内有效，启动时直接使用而不读取表格
+PROMPT_VERSION = 'v3'  # 修改翻译提示词时递增，使旧缓存失效
+TRANSLATION_CACHE_SIZE = int(os.environ.get('TRANSLATION_CACHE_SIZE', '2000'))  # 内存 LRU 条数
+TRANSLATION_CACHE_MAX_ROWS = int(os.environ.get('TRANSLATION_CACHE_MAX_ROWS', '100000'))  # 磁盘缓存条数上限
+TRANSLATION_CACHE_TTL = int(os.environ.get('TRANSLATION_CACHE_TTL', str(30 * 24 * 3600)))  # 缓存有效期（秒）
+
+
+class Metrics:
+    # 进程内指标（计数器、直方图、即时值），以 Prometheus 文本格式导出到 /metrics
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}  # 指标名 -> (类型, 说明)
+        self.counters = {}  # (指标名, 标签) -> 数值
+        self.histograms = {}  # (指标名, 标签) -> [各分桶计数, 总和, 次数]
+        self.gauges = {}  # 指标名 -> 返回当前值的函数
+
+    def counter(self, name, help_text):
+        self.meta[name] = ('counter', help_text)
+
+    def histogram(self, name, help_text):
+        self.meta[name] = ('histogram', help_text)
+
+    def gauge(self, name, help_text, func):
+        self.meta[name] = ('gauge', help_text)
+        self.gauges[name] = func
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            entry = self.histograms.get(key)
+            if entry is None:
+                entry = self.histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(entry[0]), entry[1], entry[2]) for key, entry in self.histograms.items()}
+        lines = []
+        for name, (kind, help_text) in self.meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for (metric, labels), value in counters.items():
+                    if metric == name:
+                        lines.append(f"{name}{self.format_labels(labels)} {value}")
+            elif kind == 'histogram':
+                for (metric, labels), (buckets, total, count) in histograms.items():
+                    if metric != name:
+                        continue
+                    for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                        lines.append(f"{name}_bucket{self.format_labels(labels, [('le', bound)])} {bucket_count}")
+                    lines.append(f"{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{self.format_labels(labels)} {total}")
+                    lines.append(f"{name}_count{self.format_labels(labels)} {count}")
+            else:
+                try:
+                    lines.append(f"{name} {self.gauges[name]()}")
+                except Exception as e:
+                    logging.error(f"读取指标 {name} 出错: {e}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.histogram('gemini_request_seconds', 'Gemini generate_content 调用耗时（按 key、模型和结果）')
+metrics.histogram('sheets_call_seconds', 'Google Sheets 调用耗时（按函数和结果）')
+metrics.histogram('telegram_request_seconds', 'Telegram Bot API 调用耗时（按方法和结果）')
+metrics.counter('quota_rejections_total', '因额度不足被拒绝的翻译请求')
+metrics.counter('gemini_tokens_total', 'Gemini 消耗的 token 数（按 key、模型和类型）')
+metrics.counter('translation_cache_lookups_total', '翻译缓存查询次数（按结果）')
+metrics.histogram('event_loop_lag_seconds', '事件循环调度延迟')
+metrics.counter('sheets_write_items_total', '写回队列写入 Google Sheets 的条目数（按类型）')
+metrics.counter('sheets_write_errors_total', '写回队列写入失败次数（按类型），失败的条目会重新排队')
+metrics.histogram('sheets_write_flush_seconds', '写回队列每次刷新的耗时')
+metrics.gauge('sheets_write_queue_depth', '等待写回 Google Sheets 的条目数', lambda: write_behind.queue_depth())
+metrics.gauge('translations_inflight', '正在进行的 Gemini 翻译请求数', lambda: len(inflight_translations))
+
+
+class MeteredRequest(HTTPXRequest):
+    # 记录每次 Bot API 调用的耗时
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]  # 只取方法名，URL 中含有 bot token
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            metrics.observe('telegram_request_seconds', time.perf_counter() - start, method=api_method, outcome=outcome)
+
+
+async def monitor_event_loop():
+    # 定时睡眠并测量实际唤醒时间与预期的差值，反映事件循环被阻塞的程度
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        metrics.observe('event_loop_lag_seconds', max(0.0, loop.time() - expected))
+
+
+class StartupTimer:
+    # 记录从进程启动到收到第一个更新的各阶段耗时，收到第一个更新时输出报告
+    def __init__(self, started):
+        self.last = started
+        self.phases = []  # 关键路径上的阶段：(名称, 秒)
+        self.background = []  # 后台预热阶段：(名称, 秒)
+        self.reported = False
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def record_background(self, phase, seconds):
+        self.background.append((phase, seconds))
+
+    def first_update(self):
+        if self.reported:
+            return
+        self.reported = True
+        self.mark('等待第一个更新')
+        total = sum(seconds for _, seconds in self.phases)
+        lines = [f"启动耗时报告（到第一个更新共 {total:.2f} 秒）："]
+        lines += [f"  {phase}: {seconds:.3f} 秒" for phase, seconds in self.phases]
+        lines += [f"  [后台] {phase}: {seconds:.3f} 秒" for phase, seconds in self.background]
+        logging.info("\n".join(lines))
+
+
+startup_timer = StartupTimer(STARTUP_STARTED)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # 不同用户的更新并行处理，同一用户的更新按到达顺序逐条处理
+    # （反馈、管理员输入等流程依赖 chat_data 中的会话状态，必须保持顺序）
+    def __init__(self, workers, user_queue):
+        # 基类信号量只用于限制排队中的协程总数，真正的并发由 worker 信号量控制
+        super().__init__(max_concurrent_updates=max(workers, 1) * max(user_queue, 1) * 64)
+        self.workers = asyncio.Semaphore(workers)
+        self.user_queue = user_queue
+        self.user_locks = {}  # 用户 ID -> [asyncio.Lock, 排队/处理中的更新数]
+        self.stats = {'processed': 0, 'dropped': 0}
+
+    @staticmethod
+    def update_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
 
+    async def do_process_update(self, update, coroutine):
+        startup_timer.first_update()
+        key = self.update_key(update)
+        if key is None:
+            async with self.workers:
+                await coroutine
+            self.stats['processed'] += 1
+            return
+        entry = self.user_locks.setdefault(key, [asyncio.Lock(), 0])
+        if entry[1] >= self.user_queue:
+            coroutine.close()
+            self.stats['dropped'] += 1
+            logging.warning(f"用户 {key} 排队的更新过多，已丢弃一条更新。")
+            return
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self.workers:
+                    await coroutine
+            self.stats['processed'] += 1
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self.user_locks.pop(key, None)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        # 成功返回 0，否则返回需要等待的秒数
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+
+class GeminiUnavailable(Exception):
+    pass
+
+
+def supports_gemini_features(model_name):
+    # Gemma 和图像生成实验模型既不支持 JSON 模式也不支持 system_instruction：
+    # 去掉结构化输出配置，固定说明改为放在提示词前面
+    return model_name.startswith('gemini') and 'image-generation' not in model_name
+
+
+class GeminiClient:
+    def __init__(self, key_index, api_key, model_name):
+        self.key_index = key_index
+        self.model_name = model_name
+        self.label = f"key{key_index + 1}/{model_name}"
+        # 每个 key 单独配置一次底层客户端并固定到模型上，调用时不再修改 genai 的全局配置
+        import google.generativeai as genai
+        from google.generativeai import client as genai_client
+        genai.configure(api_key=api_key)
+        self.model = genai.GenerativeModel(model_name)
+        self.model._client = genai_client.get_default_generative_client()
+        # 每类任务的固定说明只在这里放进 system_instruction 一次，请求中只发送变化的部分
+        self.system_instruction = supports_gemini_features(model_name)
+        self.models = {}
+        if self.system_instruction:
+            for task, instruction in SYSTEM_INSTRUCTIONS.items():
+                self.models[task] = genai.GenerativeModel(model_name, system_instruction=instruction)
+                self.models[task]._client = self.model._client
+        self.structured = supports_gemini_features(model_name)
+        self.bucket = TokenBucket(GEMINI_KEY_RPM / 60, GEMINI_KEY_BURST)
+        self.cooldown_until = 0.0
+        self.stats = {'calls': 0, 'errors': 0, 'rate_limited': 0, 'latency_ms': 0.0, 'prompt_tokens': 0, 'completion_tokens': 0}
+
+    def generate_content(self, prompt, task=None, **kwargs):
+        if task and not self.system_instruction:
+            prompt = f"{SYSTEM_INSTRUCTIONS[task]}\n\n{prompt}"
+        return self.models.get(task, self.model).generate_content(prompt, **kwargs)
+
+    def request_kwargs(self, kwargs):
+        # 不支持 JSON 模式的模型去掉结构化输出配置，只依靠提示词约束格式
+        if not self.structured:
+            kwargs = {key: value for key, value in kwargs.items() if key != 'generation_config'}
+        return dict(kwargs, request_options={'timeout': GEMINI_TIMEOUT})
+
+    def healthy(self, now):
+        return now >= self.cooldown_until
+
+    def observe(self, elapsed, outcome):
+        metrics.observe('gemini_request_seconds', elapsed, key=f"key{self.key_index + 1}", model=self.model_name, outcome=outcome)
+
+    def record_success(self, elapsed):
+        self.stats['calls'] += 1
+        self.observe(elapsed, 'ok')
+        # 指数滑动平均延迟
+        latency_ms = elapsed * 1000
+        self.stats['latency_ms'] = latency_ms if not self.stats['latency_ms'] else self.stats['latency_ms'] * 0.8 + latency_ms * 0.2
+
+    def record_failure(self, error, elapsed):
+        self.stats['calls'] += 1
+        if isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+            self.stats['rate_limited'] += 1
+            self.observe(elapsed, 'rate_limited')
+            self.cooldown_until = time.monotonic() + GEMINI_QUOTA_COOLDOWN
+        else:
+            self.stats['errors'] += 1
+            self.observe(elapsed, 'error')
+            self.cooldown_until = time.monotonic() + GEMINI_ERROR_COOLDOWN
+        logging.warning(f"Gemini 客户端 {self.label} 调用失败，暂停使用: {error}")
+
+
+# 配额用尽或服务端错误时切换到下一个健康的 (key, 模型)
+GEMINI_FAILOVER_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests,
+    google_exceptions.InternalServerError,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+)
+
+
+class GeminiPool:
+    def __init__(self, api_configs, models):
+        # 按 key 优先的顺序排列：先用第一个 key 的各个模型，再换下一个 key
+        self.clients = [
+            GeminiClient(key_index, config['api_key'], model_name)
+            for key_index, config in enumerate(api_configs) if config['api_key']
+            for model_name in models
+        ]
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=200)  # 最近成功请求的延迟（秒）
+        self.stats = {'hedged': 0, 'hedge_wins': 0}
+        self.usage = {}  # 任务 -> [调用次数, 输入 token, 输出 token]
+        self.translations = 0  # 调用模型完成的翻译（不含缓存命中，长文本按段计）
+
+    def acquire(self, exclude=()):
+        # 返回 (客户端, 0) 或 (None, 最短等待秒数)；没有可用客户端时等待时间为 None
+        now = time.monotonic()
+        min_wait = None
+        for client in self.clients:
+            if client in exclude:
+                continue
+            if not client.healthy(now):
+                wait = client.cooldown_until - now
+            else:
+                wait = client.bucket.try_acquire()
+                if wait == 0:
+                    return client, 0.0
+            min_wait = wait if min_wait is None else min(min_wait, wait)
+        return None, min_wait
+
+    def hedge_delay(self):
+        # 以最近成功请求的 p95 延迟作为对冲阈值
+        samples = sorted(self.latencies)
+        if len(samples) < 20:
+            return GEMINI_HEDGE_DEFAULT_DELAY
+        return max(GEMINI_HEDGE_MIN_DELAY, samples[int(len(samples) * 0.95) - 1])
+
+    def record_usage(self, client, task, response):
+        usage = getattr(response, 'usage_metadata', None)
+        if not usage:
+            return
+        prompt_tokens = usage.prompt_token_count or 0
+        completion_tokens = usage.candidates_token_count or 0
+        client.stats['prompt_tokens'] += prompt_tokens
+        client.stats['completion_tokens'] += completion_tokens
+        task = task or 'other'
+        with self.lock:
+            entry = self.usage.setdefault(task, [0, 0, 0])
+            entry[0] += 1
+            entry[1] += prompt_tokens
+            entry[2] += completion_tokens
+        labels = {'key': f"key{client.key_index + 1}", 'model': client.model_name}
+        metrics.inc('gemini_tokens_total', prompt_tokens, kind='prompt', **labels)
+        metrics.inc('gemini_tokens_total', completion_tokens, kind='completion', **labels)
+        logging.info(f"Gemini {client.label} {task}: 输入 {prompt_tokens} token，输出 {completion_tokens} token")
+
+    async def _generate_with_failover(self, prompt, kwargs, state, avoid_key=None, task=None):
+        loop = asyncio.get_running_loop()
+        tried = set()
+        deadline = time.monotonic() + GEMINI_MAX_WAIT
+        while True:
+            exclude = tried | {client for client in self.clients if client.key_index == avoid_key}
+            client, wait = self.acquire(exclude)
+            if client is None:
+                if wait is None or time.monotonic() + wait > deadline:
+                    raise GeminiUnavailable("没有可用的 Gemini 客户端。")
+                await asyncio.sleep(wait)
+                continue
+            state['client'] = client
+            start = time.perf_counter()
+            try:
+                response = await loop.run_in_executor(gemini_executor, functools.partial(
+                    client.generate_content, prompt, task, **client.request_kwargs(kwargs)))
+            except GEMINI_FAILOVER_ERRORS as e:
+                client.record_failure(e, time.perf_counter() - start)
+                tried.add(client)
+                continue
+            except Exception:
+                client.stats['calls'] += 1
+                client.stats['errors'] += 1
+                client.observe(time.perf_counter() - start, 'error')
+                raise
+            elapsed = time.perf_counter() - start
+            client.record_success(elapsed)
+            self.latencies.append(elapsed)
+            self.record_usage(client, task, response)
+            return response
+
+    async def _generate_hedged(self, prompt, kwargs, state, task=None):
+        # 返回时 state['client'] 为给出结果的客户端
+        primary = asyncio.ensure_future(self._generate_with_failover(prompt, kwargs, state, task=task))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay())
+            if done:
+                return primary.result()
+            # 主请求超过阈值仍未返回：向另一个 key 发送重复请求，采用先返回的结果
+            avoid_key = state['client'].key_index if state['client'] else None
+            hedge_state = {'client': None}
+            if any(client.key_index != avoid_key for client in self.clients):
+                self.stats['hedged'] += 1
+                tasks.add(asyncio.ensure_future(self._generate_with_failover(prompt, kwargs, hedge_state, avoid_key=avoid_key, task=task)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        if future is not primary:
+                            self.stats['hedge_wins'] += 1
+                            state['client'] = hedge_state['client']
+                        return future.result()
+                    error = future.exception()
+            raise error
+        finally:
+            for future in tasks:
+                future.cancel()
+
+    async def generate_async(self, prompt, hedge=GEMINI_HEDGE, task=None, answered_by=None, **kwargs):
+        # task 为 SYSTEM_INSTRUCTIONS 中的键，对应的固定说明不再随每个请求发送；
+        # answered_by 为 dict 时，成功后写入实际给出结果的模型名（故障切换后可能不是首选模型）
+        state = {'client': None}
+        async with gemini_semaphore:
+            if hedge:
+                coro = self._generate_hedged(prompt, kwargs, state, task)
+            else:
+                coro = self._generate_with_failover(prompt, kwargs, state, task=task)
+            response = await asyncio.wait_for(coro, GEMINI_TIMEOUT)
+        if answered_by is not None:
+            answered_by['model_name'] = state['client'].model_name
+        return response
+
+    def _open_stream(self, client, prompt, task, kwargs, loop):
+        stream = {'client': client, 'queue': asyncio.Queue(), 'stop': threading.Event(), 'start': time.perf_counter()}
+        loop.run_in_executor(gemini_executor, self._stream_worker, client, prompt, task, kwargs, stream['queue'], stream['stop'], loop)
+        return stream
+
+    def _record_stream_error(self, stream, error):
+        elapsed = time.perf_counter() - stream['start']
+        if isinstance(error, GEMINI_FAILOVER_ERRORS + (asyncio.TimeoutError,)):
+            stream['client'].record_failure(error, elapsed)
+        else:
+            stream['client'].stats['calls'] += 1
+            stream['client'].stats['errors'] += 1
+            stream['client'].observe(elapsed, 'error')
+
+    async def _first_stream_event(self, prompt, task, kwargs, deadline, hedge, streams):
+        # 等待第一段输出，返回 (产出第一段的流, 第一个事件)；收到之前可故障切换，
+        # 超过对冲阈值仍无输出时在另一个 key 上再开一个流，采用先产出的那个
+        loop = asyncio.get_running_loop()
+        tried = set()
+        hedged = not hedge
+        while True:
+            if not streams:
+                client, wait = self.acquire(tried)
+                if client is None:
+                    if wait is None or loop.time() + wait > deadline:
+                        raise GeminiUnavailable("没有可用的 Gemini 客户端。")
+                    await asyncio.sleep(wait)
+                    continue
+                streams.append(self._open_stream(client, prompt, task, kwargs, loop))
+            timeout = max(0.0, deadline - loop.time())
+            if not hedged:
+                timeout = min(timeout, self.hedge_delay())
+            getters = {asyncio.ensure_future(stream['queue'].get()): stream for stream in streams}
+            done, pending = await asyncio.wait(getters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for getter in pending:
+                getter.cancel()
+            if not done:
+                if loop.time() >= deadline:
+                    error = asyncio.TimeoutError()
+                    for stream in streams:
+                        self._record_stream_error(stream, error)
+                    raise error
+                hedged = True
+                avoid_key = streams[0]['client'].key_index
+                client, _ = self.acquire(tried | {client for client in self.clients if client.key_index == avoid_key})
+                if client is not None:
+                    self.stats['hedged'] += 1
+                    streams.append(dict(self._open_stream(client, prompt, task, kwargs, loop), hedge=True))
+                continue
+            for getter in done:
+                stream = getters[getter]
+                event = getter.result()
+                if event[0] != 'error':
+                    if stream.get('hedge'):
+                        self.stats['hedge_wins'] += 1
+                    return stream, event
+                self._record_stream_error(stream, event[1])
+                if not isinstance(event[1], GEMINI_FAILOVER_ERRORS):
+                    raise event[1]
+                tried.add(stream['client'])
+                streams.remove(stream)
+                stream['stop'].set()
+
+    async def stream_async(self, prompt, hedge=GEMINI_HEDGE, task=None, answered_by=None, **kwargs):
+        # 流式生成，逐段产出文本；只在收到第一段之前进行故障切换和对冲。answered_by 同 generate_async
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + GEMINI_TIMEOUT
+        streams = []
+        async with gemini_semaphore:
+            try:
+                stream, (kind, value) = await self._first_stream_event(prompt, task, kwargs, deadline, hedge, streams)
+                for opened in streams:
+                    if opened is not stream:
+                        opened['stop'].set()
+                client = stream['client']
+                if answered_by is not None:
+                    answered_by['model_name'] = client.model_name
+                try:
+                    while kind == 'chunk':
+                        yield value
+                        kind, value = await asyncio.wait_for(stream['queue'].get(), max(0.0, deadline - loop.time()))
+                    if kind == 'error':
+                        raise value
+                except Exception as e:
+                    self._record_stream_error(stream, e)
+                    raise
+                elapsed = time.perf_counter() - stream['start']
+                client.record_success(elapsed)
+                self.latencies.append(elapsed)
+                self.record_usage(client, task, value)
+            finally:
+                # 落选的流在工作线程收到下一段时退出
+                for opened in streams:
+                    opened['stop'].set()
+
+    @staticmethod
+    def _stream_worker(client, prompt, task, kwargs, queue, stop, loop):
+        try:
+            response = client.generate_content(prompt, task, stream=True, **client.request_kwargs(kwargs))
+            for chunk in response:
+                if stop.is_set():
+                    return
+                try:
+                    text = chunk.text
+                except ValueError:
+                    continue  # 没有文本内容的分块（例如只带结束原因）
+                loop.call_soon_threadsafe(queue.put_nowait, ('chunk', text))
+            loop.call_soon_threadsafe(queue.put_nowait, ('done', response))
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, ('error', e))
+
+    def summary(self):
+        now = time.monotonic()
+        lines = ["Gemini 客户端："]
+        for client in self.clients:
+            state = '冷却中' if not client.healthy(now) else '正常'
+            lines.append(f"{client.label}: {state}, 调用 {client.stats['calls']}, 错误 {client.stats['errors']}, 429 {client.stats['rate_limited']}, 平均延迟 {client.stats['latency_ms']:.0f} ms")
+        lines.append(f"对冲请求 {self.stats['hedged']} 次，其中 {self.stats['hedge_wins']} 次先返回，当前阈值 {self.hedge_delay():.1f} 秒")
+        return "\n".join(lines)
+
+    def token_summary(self):
+        lines = ["Token 用量：", "按任务："]
+        with self.lock:
+            usage = {task: list(entry) for task, entry in self.usage.items()}
+        for task, (calls, prompt_tokens, completion_tokens) in sorted(usage.items()):
+            lines.append(f"{task}: 调用 {calls} 次，输入 {prompt_tokens}，输出 {completion_tokens}，平均每次 {(prompt_tokens + completion_tokens) / calls:.0f}")
+        translation_tokens = sum(sum(usage.get(task, [0, 0, 0])[1:]) for task in ('translate', 'translate_batch'))
+        if self.translations:
+            lines.append(f"平均每次翻译 {translation_tokens / self.translations:.0f} token（{self.translations} 次调用模型的翻译，长文本按段计，含对冲和重试）")
+        lines.append("按 key / 模型：")
+        for client in self.clients:
+            if client.stats['prompt_tokens'] or client.stats['completion_tokens']:
+                lines.append(f"{client.label}: 输入 {client.stats['prompt_tokens']}，输出 {client.stats['completion_tokens']}")
+        return "\n".join(lines)
+
+
+gemini_pool = None
+gemini_pool_lock = threading.Lock()
+gemini_pool_future = None
+
+
+def get_gemini_pool():
+    global gemini_pool
+    with gemini_pool_lock:
+        if gemini_pool is None:
+            gemini_pool = GeminiPool(API_CONFIGS, GEMINI_MODELS)
+        return gemini_pool
+
+
+async def get_gemini_pool_async():
+    # 协程中使用：预热完成前收到的更新在 Gemini 线程池中等待构建（导入 SDK 需要数秒），
+    # 不阻塞事件循环；并发的调用者共用同一次构建，构建失败后下次调用重试
+    global gemini_pool_future
+    if gemini_pool is not None:
+        return gemini_pool
+    if gemini_pool_future is None or (gemini_pool_future.done() and gemini_pool_future.exception()):
+        gemini_pool_future = asyncio.get_running_loop().run_in_executor(gemini_executor, get_gemini_pool)
+    return await asyncio.shield(gemini_pool_future)
 
-def get_current_api_config():
-    return API_CONFIGS[current_api_index]
 
+def clean_text(text):
+    text = text.replace('*', '')
+    text = re.sub(r'\n\s*\n', '\n', text)
+    return text.strip()
 
-def get_current_model():
-    return GEMINI_MODELS[current_model_index]
 
+def load_credentials():
+    try:
+        credentials = json.loads(base64.b64decode(GOOGLE_CREDENTIALS_BASE64).decode('utf-8'))
+    except (ValueError, TypeError) as e:
+        logging.error(f"解码 GOOGLE_CREDENTIALS_BASE64 出错: {e}")
+        return None
+    logging.info("成功加载凭据。")
+    return credentials
 
-def switch_to_next_model():
-    global current_model_index
-    current_model_index = (current_model_index + 1) % len(GEMINI_MODELS)
-    print(f"Switched to model: {get_current_model()}")
 
+def get_sheets_credentials():
+    global sheets_credentials
+    with sheets_client_lock:
+        if sheets_credentials is None and GOOGLE_CREDENTIALS_BASE64:
+            credentials_info = load_credentials()
+            if credentials_info:
+                from google.oauth2 import service_account
+                sheets_credentials = service_account.Credentials.from_service_account_info(credentials_info, scopes=['https://www.googleapis.com/auth/spreadsheets'])
+                logging.debug("使用环境变量中的凭据创建 Google Sheets 凭据。")
+        return sheets_credentials
 
-def switch_to_next_api():
-    global current_api_index, current_model_index
-    current_api_index = (current_api_index + 1) % len(API_CONFIGS)
-    current_model_index = 0
-    print(f"Switched to API: {get_current_api_config()['api_key']}, model: {get_current_model()}")
 
+def get_sheets_service():
+    # 整个进程共用一份凭据（令牌只在过期时刷新一次）；httplib2 连接不是线程安全的，
+    # 因此每个线程各自持有一个保持长连接的客户端，使用内置的静态发现文档构建
+    service = getattr(sheets_local, 'service', None)
+    if service is None:
+        creds = get_sheets_credentials()
+        if not creds:
+            logging.warning("无法创建 Google Sheets 服务，因为凭据未加载。")
+            return None
+        import google_auth_httplib2
+        import httplib2
+        from googleapiclient.discovery import build
+        http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=SHEETS_HTTP_TIMEOUT))
+        service = build('sheets', 'v4', http=http, cache_discovery=False, static_discovery=True)
+        sheets_local.service = service
+    return service
+
+
+def timed_sheets_call(func, *args):
+    start = time.perf_counter()
+    outcome = 'ok'
+    try:
+        return func(*args)
+    except Exception:
+        outcome = 'error'
+        raise
+    finally:
+        metrics.observe('sheets_call_seconds', time.perf_counter() - start, func=getattr(func, '__name__', 'unknown'), outcome=outcome)
 
-def clean_text(text):
-    text = text.replace('*', '')
-    text = re.sub(r'\n\s*\n', '\n', text)
-    return text.strip()
 
+async def run_sheets(func, *args, timeout=SHEETS_CALL_TIMEOUT):
+    # 在有界线程池中执行阻塞的 Sheets 调用，不阻塞事件循环
+    async with sheets_semaphore:
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(sheets_executor, functools.partial(timed_sheets_call, func, *args)), timeout)
 
-def get_sheets_service():
-    scopes = ['https://www.googleapis.com/auth/spreadsheets']
-    global CREDENTIALS
-    if CREDENTIALS:
-        creds = service_account.Credentials.from_service_account_info(CREDENTIALS, scopes=scopes)
-        logging.debug("使用环境变量中的凭据创建 Google Sheets 服务。")
-        return build('sheets', 'v4', credentials=creds)
-    else:
-        logging.warning("无法创建 Google Sheets 服务，因为凭据未加载。")
-        return None
 
+def run_local_db(func, *args):
+    # 立即提交到本地数据库线程并返回 Future：需要结果时 await，不需要时（如写缓存）直接丢弃，提交顺序不变
+    return asyncio.get_running_loop().run_in_executor(local_db_executor, functools.partial(func, *args))
 
-async def save_translation_history(user_id, original_text, translated_text):
+
+def run_in_background(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+def read_sheet_values(range_name):
     service = get_sheets_service()
-    if service:
-        history_sheet_name = 'TranslationHistory'
-        timestamp = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=7))).strftime('%Y-%m-%d %H:%M:%S')  # 老挝时间
-        new_record = [str(user_id), timestamp, original_text, translated_text]
-        body = {
-            'values': [new_record]
-        }
-        try:
-            response = service.spreadsheets().values().append(
-                spreadsheetId=SHEET_ID,
-                range=history_sheet_name,
-                valueInputOption='RAW',
-                body=body
-            ).execute()
-            logging.info(f"保存翻译历史到 Google Sheets: {response}")
-        except Exception as e:
-            logging.error(f"保存翻译历史时出错: {e}")
-            print(f"保存翻译历史时出错: {e}")
+    if not service:
+        raise RuntimeError("无法连接到 Google Sheets。")
+    result = service.spreadsheets().values().get(spreadsheetId=SHEET_ID, range=range_name).execute()
+    return result.get('values', [])
+
+
+def lao_now():
+    return datetime.datetime.now(LAO_TZ)
+
+
+def parse_row_number(a1_range):
+    # 'UserStats!A12:E12' -> 12
+    match = re.search(r'![A-Z]+(\d+)', a1_range or '')
+    return int(match.group(1)) if match else None
+
+
+def sheet_range_has_quota_column():
+    # SHEET_RANGE 必须包含 F 列（每日额度），例如 UserStats!A2:F；没有结束列时视为整张表
+    match = re.search(r':([A-Z]+)\d*$', SHEET_RANGE or '')
+    if not match:
+        return True
+    column = match.group(1)
+    quota_column = USER_FIELD_COLUMNS['daily_quota']
+    return (len(column), column) >= (len(quota_column), quota_column)
 
 
-def get_user_info(user_id, username='default_user'):
+def parse_int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def row_to_user(row, row_number):
+    if not row or not row[0]:
+        return None
+    return {
+        'user_id': row[0],
+        'username': row[1] if len(row) > 1 else 'default_user',
+        'daily_limit': parse_int(row[2] if len(row) > 2 else None),
+        'remaining_days': parse_int(row[3] if len(row) > 3 else None),
+        'join_date': row[4] if len(row) > 4 else lao_now().strftime('%Y-%m-%d'),  # 获取加入日期，如果不存在则设置当前日期
+        'daily_quota': parse_int(row[5] if len(row) > 5 else None, DEFAULT_DAILY_LIMIT) or DEFAULT_DAILY_LIMIT,
+        'row': row_number,
+    }
+
+
+def load_user_table():
+    # 一次性读取 UserStats，建立 user_id -> 行 的索引。读取期间持有 flush_lock，
+    # 待写单元格不会在读到旧值之后、叠加本地修改之前被刷新掉
     service = get_sheets_service()
-    user_data = None
-    logging.info(f"get_user_info called for user_id: {user_id}")
-    if service:
-        logging.info(f"SHEET_ID 的值: {SHEET_ID}")
-        logging.info(f"SHEET_RANGE 的值 (在 get_user_info 中): {SHEET_RANGE}")
+    if not service:
+        return False
+    with write_behind.flush_lock:
         try:
             result = service.spreadsheets().values().get(spreadsheetId=SHEET_ID, range=SHEET_RANGE).execute()
-            values = result.get('values', [])
-            if values:
-                for row in values:  # 注意：这里不再跳过第一行，因为 SHEET_RANGE 从 A2 开始
-                    if row and row[0] == str(user_id):
-                        user_data = {
-                            'user_id': row[0],
-                            'username': row[1],
-                            'daily_limit': int(row[2]),
-                            'remaining_days': int(row[3]),
-                            'join_date': row[4] if len(row) > 4 else datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=7))).strftime('%Y-%m-%d')  # 获取加入日期，如果不存在则设置当前日期
-                        }
-                        logging.info(f"get_user_info found existing user: {user_data}")
-                        return user_data
         except Exception as e:
-            logging.error(f"get_user_info API error: {e}")
-            print(f"get_user_info API error: {e}")
-
-    # 如果完全没有找到用户信息，则写入新用户
-    if not user_data:
-        new_user_data = [str(user_id), username, '3', '3', datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=7))).strftime('%Y-%m-%d')]  # 添加加入日期
-        body = {
-            'values': [new_user_data]
-        }
-        try:
-            response = service.spreadsheets().values().append(
-                spreadsheetId=SHEET_ID,
-                range=SHEET_RANGE.split('!')[0],  # 只使用工作表名称
-                valueInputOption='RAW',
-                body=body
-            ).execute()
-            logging.info(f"get_user_info added new user {user_id} to Google Sheets: {response}")
-            time.sleep(2)  # 添加 2 秒延迟
-
-            # 立即再次读取数据进行验证并打印
-            verification_result = service.spreadsheets().values().get(spreadsheetId=SHEET_ID, range=SHEET_RANGE).execute()
-            verification_values = verification_result.get('values', [])
-            logging.info(f"get_user_info - Verification read after append: {verification_values}")
-            print(f"get_user_info - Verification read after append: {verification_values}")  # 打印验证结果
-
-            return {'user_id': str(user_id), 'username': username, 'daily_limit': 3, 'remaining_days': 3, 'join_date': datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=7))).strftime('%Y-%m-%d')}
-        except Exception as e:
-            logging.error(f"get_user_info error writing new user: {e}")
-            print(f"向 Google Sheets 写入新用户信息时出错: {e}")
-            return {'user_id': str(user_id), 'username': username, 'daily_limit': 3, 'remaining_days': 3, 'join_date': datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=7))).strftime('%Y-%m-%d')}
-    logging.info(f"get_user_info returning user_data: {user_data}")
-    return user_data
+            logging.error(f"load_user_table API error: {e}")
+            return False
+        return replace_user_table(result.get('values', []))
+
+
+def replace_user_table(rows):
+    # 用读到的表格行替换用户表，调用方持有 flush_lock
+    global user_table_loaded
+    first_row = parse_row_number(SHEET_RANGE) or 1
+    has_quota_column = sheet_range_has_quota_column()
+    if not has_quota_column:
+        logging.warning(f"SHEET_RANGE={SHEET_RANGE} 不包含 F 列（每日额度），每日重置将被跳过，请改为例如 UserStats!A2:F。")
+    table = {}
+    migrated = 0
+    # 叠加本地修改和替换用户表在同一临界区内完成：预留额度时的修改和排队也持有 user_table_lock，不会夹在中间丢失
+    with user_table_lock:
+        pending_cells = write_behind.pending_snapshot()[0]
+        for i, row in enumerate(rows):
+            user = row_to_user(row, first_row + i)
+            if not user:
+                continue
+            # 尚未写回表格的修改以本地为准
+            quota_pending = f'UserStats!{USER_FIELD_COLUMNS["daily_quota"]}{user["row"]}' in pending_cells
+            for field, column in USER_FIELD_COLUMNS.items():
+                pending = pending_cells.get(f'UserStats!{column}{user["row"]}')
+                if pending is not None:
+                    user[field] = parse_int(pending)
+            if has_quota_column and not quota_pending and (len(row) <= 5 or not row[5]) and user['daily_limit'] > DEFAULT_DAILY_LIMIT:
+                # 旧数据只在 C 列保存管理员设置的次数：复制到 F 列，避免每日重置把它改回默认值
+                user['daily_quota'] = user['daily_limit']
+                write_behind.put_cell(f'UserStats!{USER_FIELD_COLUMNS["daily_quota"]}{user["row"]}', user['daily_limit'])
+                migrated += 1
+            table[user['user_id']] = user
+        user_table.clear()
+        user_table.update(table)
+        user_table_loaded = True
+        usage_stats.recount_expiring(user_table.values())
+    if migrated:
+        logging.info(f"已把 {migrated} 位用户 C 列的自定义次数复制到 F 列作为每日额度。")
+    logging.info(f"用户表已加载，共 {len(table)} 位用户。")
+    return True
+
+
+def ensure_user_table():
+    if not user_table_loaded:
+        load_user_table()
+
+
+def lookup_user(user_id):
+    with user_table_lock:
+        user = user_table.get(str(user_id))
+        return {k: v for k, v in user.items() if k != 'row'} if user else None
+
+
+class UsageStats:
+    # 随翻译和用户表变化增量更新的统计，管理员查看时无需读取表格
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.day = None
+        self.active_today = set()
+        self.quota_used_today = 0
+        self.translations_per_day = OrderedDict()  # 日期 -> 翻译次数，保留最近 7 天
+        self.expiring_soon = 0
+
+    @staticmethod
+    def is_expiring(remaining_days):
+        return 0 < remaining_days <= EXPIRING_SOON_DAYS
+
+    def _roll_day(self):
+        today = lao_now().strftime('%Y-%m-%d')
+        if today != self.day:
+            self.day = today
+            self.active_today = set()
+            self.quota_used_today = 0
+            self.translations_per_day.setdefault(today, 0)
+            while len(self.translations_per_day) > 7:
+                self.translations_per_day.popitem(last=False)
+
+    def record_translation(self, user_id, quota_used=1):
+        with self.lock:
+            self._roll_day()
+            self.active_today.add(user_id)
+            self.quota_used_today += quota_used
+            self.translations_per_day[self.day] += 1
+
+    def remaining_days_changed(self, old_days, new_days):
+        with self.lock:
+            self.expiring_soon += self.is_expiring(new_days) - (old_days is not None and self.is_expiring(old_days))
+
+    def recount_expiring(self, users):
+        with self.lock:
+            self.expiring_soon = sum(1 for user in users if self.is_expiring(user['remaining_days']))
+
+    def summary(self):
+        with self.lock:
+            self._roll_day()
+            per_day = "\n".join(f"{day}: `{count}`" for day, count in self.translations_per_day.items())
+            return (f"总用户数: `{len(user_table)}`\n今日活跃用户: `{len(self.active_today)}`\n今日已用翻译次数: `{self.quota_used_today}`\n"
+                    f"{EXPIRING_SOON_DAYS} 天内到期用户: `{self.expiring_soon}`\n\n每日翻译次数:\n{per_day}")
+
+
+usage_stats = UsageStats()
+
+
+def reconcile_user_table():
+    # 以表格为准对账：先写回本地尚未写入的额度变化，再重新读取整张表；
+    # 整个过程持有 flush_lock，定时刷新不会插在写回和读取之间
+    with write_behind.flush_lock:
+        write_behind.flush()
+        return load_user_table()
+
+
+async def refresh_user_table(context: CallbackContext):
+    await run_sheets(reconcile_user_table)
+
+
+class SheetsWriteBehind:
+    # 写回队列：合并待写单元格（同一单元格只保留最后一次写入），
+    # 每个刷新周期只发一次 values().batchUpdate 和一次 values().append
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.RLock()  # 对账时在刷新和读取整张表之间一直持有
+        self.cells = {}  # A1 范围 -> 值
+        self.history_rows = []
+        self.stats = {'flushes': 0, 'cells_written': 0, 'rows_appended': 0, 'errors': 0, 'last_flush_ms': 0.0, 'max_flush_ms': 0.0, 'total_flush_ms': 0.0}
+
+    def queue_depth(self):
+        with self.lock:
+            return len(self.cells) + len(self.history_rows)
+
+    def put_cell(self, a1_range, value):
+        with self.lock:
+            self.cells[a1_range] = str(value)
+            return len(self.cells) + len(self.history_rows) >= WRITE_BATCH_SIZE
+
+    def put_history(self, row):
+        with self.lock:
+            self.history_rows.append(row)
+            return len(self.cells) + len(self.history_rows) >= WRITE_BATCH_SIZE
+
+    def discard_cells(self, *columns):
+        # 丢弃指定列上尚未写回的单元格（已被整列写入取代）
+        with self.lock:
+            for a1_range in list(self.cells):
+                if cell_column(a1_range) in columns:
+                    del self.cells[a1_range]
+
+    def pending_snapshot(self):
+        # 同时返回取快照的时间，恢复时与之后成功写回的时间比较
+        with self.lock:
+            return dict(self.cells), list(self.history_rows), time.time()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                cells, self.cells = self.cells, {}
+                rows, self.history_rows = self.history_rows, []
+                taken_at = time.time()
+            if not cells and not rows:
+                return
+            service = get_sheets_service()
+            if not service:
+                self.requeue(cells, rows)
+                return
+            start = time.perf_counter()
+            if cells:
+                body = {
+                    'value_input_option': 'RAW',
+                    'data': [{'range': a1_range, 'values': [[value]]} for a1_range, value in cells.items()]
+                }
+                try:
+                    service.spreadsheets().values().batchUpdate(spreadsheetId=SHEET_ID, body=body).execute()
+                    self.stats['cells_written'] += len(cells)
+                    metrics.inc('sheets_write_items_total', len(cells), kind='cell')
+                    cells = {}
+                    # 此前快照里的待写单元格都已写入（或被更新的值取代），重启时不再重放
+                    set_meta('cells_flushed_at', taken_at)
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    metrics.inc('sheets_write_errors_total', kind='cell')
+                    logging.error(f"写回单元格时出错，稍后重试: {e}")
+            if rows:
+                try:
+                    service.spreadsheets().values().append(
+                        spreadsheetId=SHEET_ID,
+                        range=HISTORY_SHEET_NAME,
+                        valueInputOption='RAW',
+                        body={'values': rows}
+                    ).execute()
+                    self.stats['rows_appended'] += len(rows)
+                    metrics.inc('sheets_write_items_total', len(rows), kind='history')
+                    rows = []
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    metrics.inc('sheets_write_errors_total', kind='history')
+                    logging.error(f"保存翻译历史时出错，稍后重试: {e}")
+            self.requeue(cells, rows)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.stats['flushes'] += 1
+            self.stats['last_flush_ms'] = elapsed_ms
+            self.stats['max_flush_ms'] = max(self.stats['max_flush_ms'], elapsed_ms)
+            self.stats['total_flush_ms'] += elapsed_ms
+            metrics.observe('sheets_write_flush_seconds', elapsed_ms / 1000)
+            logging.info(f"写回队列刷新完成，耗时 {elapsed_ms:.0f} ms，剩余队列深度 {self.queue_depth()}")
+
+    def summary(self):
+        flushes = self.stats['flushes']
+        average_ms = self.stats['total_flush_ms'] / flushes if flushes else 0
+        return (f"表格写回：刷新 {flushes} 次，写入 {self.stats['cells_written']} 个单元格、{self.stats['rows_appended']} 条历史，出错 {self.stats['errors']} 次，"
+                f"平均耗时 {average_ms:.0f} ms（最长 {self.stats['max_flush_ms']:.0f} ms），当前队列 {self.queue_depth()}")
+
+    def requeue(self, cells, rows):
+        # 失败的写入放回队列；期间已有更新的单元格以新值为准
+        with self.lock:
+            for a1_range, value in cells.items():
+                self.cells.setdefault(a1_range, value)
+            self.history_rows[:0] = rows
+
+
+def cell_column(a1_range):
+    match = re.fullmatch(r'UserStats!([A-Z]+)\d+', a1_range)
+    return match.group(1) if match else None
+
+
+write_behind = SheetsWriteBehind()
+
+
+def request_write_flush():
+    # 队列达到批量大小时，在 Sheets 线程池中刷新，不阻塞调用方
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        write_behind.flush()
+        return
+    run_in_background(run_sheets(write_behind.flush))
+
+
+async def flush_sheet_writes(context: CallbackContext):
+    await run_sheets(write_behind.flush)
+
+
+async def flush_on_shutdown(application):
+    await run_sheets(write_behind.flush)
+
+
+def snapshot_state(bot_data, final=False):
+    # 把进程内状态放进 bot_data，由 PicklePersistence 按 PERSISTENCE_INTERVAL 合并写入磁盘；
+    # 翻译开关直接使用同一个字典。待写回的单元格可以重复写入，随时保存；
+    # 待追加的历史行只在退出时保存，避免崩溃后重放已经写过的行
+    bot_data['translation_status'] = user_translation_status
+    with user_table_lock:
+        if user_table_loaded:
+            bot_data['user_table'] = {user_id: dict(user) for user_id, user in user_table.items()}
+            bot_data['snapshot_at'] = time.time()
+    cells, rows, taken_at = write_behind.pending_snapshot()
+    bot_data['pending_cells'] = cells
+    bot_data['pending_cells_at'] = taken_at
+    bot_data['pending_history'] = rows if final else []
+
+
+async def snapshot_state_job(context: CallbackContext):
+    snapshot_state(context.application.bot_data)
+
+
+def restore_state(bot_data):
+    # 启动时恢复快照：翻译开关、未写回的修改，以及足够新的用户表（此时不再读取整张表）
+    global user_table_loaded
+    user_translation_status.update(bot_data.get('translation_status') or {})
+    bot_data['translation_status'] = user_translation_status
+    cells = replayable_cells(bot_data)
+    rows = bot_data.get('pending_history') or []
+    for a1_range, value in cells.items():
+        write_behind.put_cell(a1_range, value)
+    for row in rows:
+        write_behind.put_history(row)
+    bot_data['pending_history'] = []
+    snapshot = bot_data.get('user_table')
+    age = time.time() - bot_data.get('snapshot_at', 0)
+    if snapshot and age < WARM_STATE_MAX_AGE:
+        with user_table_lock:
+            user_table.clear()
+            user_table.update(snapshot)
+            user_table_loaded = True
+            usage_stats.recount_expiring(user_table.values())
+        logging.info(f"已从快照恢复 {len(snapshot)} 位用户（{age:.0f} 秒前保存），{len(cells)} 个待写回单元格，{len(rows)} 条待追加历史。")
+    else:
+        logging.info(f"没有可用的用户表快照，将从表格读取；已恢复 {len(cells)} 个待写回单元格，{len(rows)} 条待追加历史。")
 
 
-def get_all_user_ids():
+def replayable_cells(bot_data):
+    # 快照最多落后 PERSISTENCE_INTERVAL 秒：快照之后已有成功的写回时，其中的单元格都已写入；
+    # 快照之后做过每日重置时，C/D 列的旧值会覆盖重置结果，都不能重放
+    cells = bot_data.get('pending_cells') or {}
+    taken_at = bot_data.get('pending_cells_at')
+    if not cells or taken_at is None:
+        return cells
+    if float(get_meta('cells_flushed_at', 0)) >= taken_at:
+        logging.info(f"快照之后已成功写回，丢弃快照中的 {len(cells)} 个待写回单元格。")
+        return {}
+    if float(get_meta('daily_reset_at', 0)) >= taken_at:
+        reset_columns = (USER_FIELD_COLUMNS['daily_limit'], USER_FIELD_COLUMNS['remaining_days'])
+        return {a1_range: value for a1_range, value in cells.items() if cell_column(a1_range) not in reset_columns}
+    return cells
+
+
+async def on_startup(application):
+    restore_state(application.bot_data)
+    await resume_broadcasts(application)
+
+
+async def save_translation_history(user_id, original_text, translated_text):
+    timestamp = lao_now().strftime('%Y-%m-%d %H:%M:%S')  # 老挝时间
+    await run_local_db(store_history, [(int(user_id), timestamp, original_text, translated_text)])
+    if write_behind.put_history([str(user_id), timestamp, original_text, translated_text]):
+        request_write_flush()
+
+
+def append_new_user(user_id, username):
+    join_date = lao_now().strftime('%Y-%m-%d')
+    new_user_data = [str(user_id), username, str(DEFAULT_DAILY_LIMIT), '3', join_date]  # 添加加入日期
+    body = {
+        'values': [new_user_data]
+    }
     service = get_sheets_service()
-    if service:
-        try:
-            result = service.spreadsheets().values().get(spreadsheetId=SHEET_ID, range=SHEET_RANGE).execute()
-            values = result.get('values', [])
-            if values:
-                return [int(row[0]) for row in values]
-        except Exception as e:
-            print(f"get_all_user_ids API error: {e}")
-    return []
+    response = service.spreadsheets().values().append(
+        spreadsheetId=SHEET_ID,
+        range=SHEET_RANGE.split('!')[0],  # 只使用工作表名称
+        valueInputOption='RAW',
+        body=body
+    ).execute()
+    logging.info(f"get_user_info added new user {user_id} to Google Sheets.")
+    row_number = parse_row_number(response.get('updates', {}).get('updatedRange', ''))
+    if row_number:
+        with user_table_lock:
+            user_table[str(user_id)] = row_to_user(new_user_data, row_number)
+        usage_stats.remaining_days_changed(None, 3)
+    return row_number
+
+
+def default_user_info(user_id, username):
+    return {'user_id': str(user_id), 'username': username, 'daily_limit': DEFAULT_DAILY_LIMIT, 'remaining_days': 3, 'join_date': lao_now().strftime('%Y-%m-%d')}
+
+
+async def get_user_info(user_id, username='default_user'):
+    logging.debug(f"get_user_info called for user_id: {user_id}")
+    try:
+        if not user_table_loaded:
+            await run_sheets(load_user_table)
+    except Exception as e:
+        logging.error(f"get_user_info API error: {e}")
+    user_data = lookup_user(user_id)
+    if user_data:
+        return user_data
+    if not user_table_loaded:
+        # 用户表尚未加载成功时不写入，以免重复录入
+        return default_user_info(user_id, username)
+
+    # 表格中没有该用户，则写入新用户
+    try:
+        row_number = await run_sheets(append_new_user, user_id, username)
+        if not row_number:
+            # 无法从返回结果中得到行号时，稍候重新读取整张表来定位新行
+            await asyncio.sleep(2)
+            await run_sheets(load_user_table)
+    except Exception as e:
+        logging.error(f"get_user_info error writing new user: {e}")
+        print(f"向 Google Sheets 写入新用户信息时出错: {e}")
+    return lookup_user(user_id) or default_user_info(user_id, username)
+
+
+def get_all_user_ids():
+    ensure_user_table()
+    with user_table_lock:
+        rows = sorted(user_table.values(), key=lambda u: u['row'])
+    return [int(u['user_id']) for u in rows if u['user_id'].isdigit()]
+
+
+def update_user_field(user_id, field, value):
+    column = USER_FIELD_COLUMNS[field]
+    with user_table_lock:
+        user = user_table.get(str(user_id))
+        if user:
+            old_value = user[field]
+            user[field] = value
+            # 与用户表修改在同一临界区内排队，每日重置和对账不会漏掉或覆盖这次修改
+            flush_needed = write_behind.put_cell(f'UserStats!{column}{user["row"]}', value)
+    if not user:
+        print(f"警告：找不到用户 ID {user_id} 来更新 {field}。")
+        return
+    if field == 'remaining_days':
+        usage_stats.remaining_days_changed(old_value, value)
+    if flush_needed:
+        request_write_flush()
 
 
 def update_user_daily_limit(user_id, daily_limit):
-    service = get_sheets_service()
-    if service:
-        logging.info(f"update_user_daily_limit - SHEET_ID: {SHEET_ID}")
-        logging.info(f"update_user_daily_limit - SHEET_RANGE: {SHEET_RANGE}")
-        try:
-            result = service.spreadsheets().values().get(spreadsheetId=SHEET_ID, range=SHEET_RANGE).execute()
-            values = result.get('values', [])
-            if values:  # 确保有数据
-                for i, row in enumerate(values):  # 从 values 的第一个元素开始遍历
-                    if row[0] == str(user_id):
-                        body = {
-                            'value_input_option': 'RAW',
-                            'data': [
-                                {
-                                    'range': f'UserStats!C{i + 2}',  # 行号应该是 i + 2，假设次数在 C 列
-                                    'values': [[str(daily_limit)]]
-                                }
-                            ]
-                        }
-                        update_result = service.spreadsheets().values().batchUpdate(spreadsheetId=SHEET_ID, body=body).execute()
-                        print(f"update_user_daily_limit API response: {update_result}")
-                        return  # 找到并更新后就返回
-                print(f"警告：找不到用户 ID {user_id} 来更新每日限制。")  # 如果遍历完没有找到匹配的 ID
-        except Exception as e:
-            print(f"update_user_daily_limit API error: {e}")
+    update_user_field(user_id, 'daily_limit', daily_limit)
 
 
 def update_user_remaining_days(user_id, remaining_days):
+    update_user_field(user_id, 'remaining_days', remaining_days)
+
+
+class QuotaLedger:
+    # 进程内额度账本：在用户表上原子地检查并预留额度，失败时退还，
+    # 变化通过写回队列同步到 UserStats，定时对账以表格为准
+    def __init__(self):
+        self.reserved = {}  # user_id -> 尚未确认的预留次数
+        self.stats = {'reserved': 0, 'committed': 0, 'refunded': 0, 'rejected': 0}
+
+    def reserve(self, user_id, fallback=None, count=1):
+        # 返回 (状态, 预留后的剩余次数, 剩余天数)，状态为 'ok'、'no_days' 或 'no_quota'
+        with user_table_lock:
+            user = user_table.get(str(user_id)) or fallback
+            if user['remaining_days'] <= 0:
+                self.stats['rejected'] += 1
+                metrics.inc('quota_rejections_total', reason='no_days')
+                return 'no_days', user['daily_limit'], user['remaining_days']
+            if user['daily_limit'] < count:
+                self.stats['rejected'] += 1
+                metrics.inc('quota_rejections_total', reason='no_quota')
+                return 'no_quota', user['daily_limit'], user['remaining_days']
+            self._adjust(user_id, -count)
+            if user is fallback:
+                user['daily_limit'] -= count
+            self.reserved[user_id] = self.reserved.get(user_id, 0) + count
+            self.stats['reserved'] += count
+            return 'ok', user['daily_limit'], user['remaining_days']
+
+    def commit(self, user_id, count=1):
+        with user_table_lock:
+            self._release(user_id, count)
+            self.stats['committed'] += count
+
+    def refund(self, user_id, count=1):
+        with user_table_lock:
+            self._release(user_id, count)
+            self._adjust(user_id, count)
+            self.stats['refunded'] += count
+
+    def _release(self, user_id, count):
+        left = self.reserved.get(user_id, 0) - count
+        if left > 0:
+            self.reserved[user_id] = left
+        else:
+            self.reserved.pop(user_id, None)
+
+    def _adjust(self, user_id, delta):
+        user = user_table.get(str(user_id))
+        if user:
+            update_user_daily_limit(user_id, user['daily_limit'] + delta)
+        elif delta < 0:
+            # 用户表暂不可用（例如表格读取失败），只在本次请求内生效
+            logging.warning(f"用户 {user_id} 不在用户表中，额度变化未记录。")
+
+
+quota_ledger = QuotaLedger()
+
+
+def reset_daily_quotas():
+    # 每个老挝日只执行一次：C 列恢复为每日额度，D 列剩余天数减一，整列一次 batchUpdate 写回
+    today = lao_now().strftime('%Y-%m-%d')
+    if get_meta('daily_reset_date') == today:
+        logging.info(f"{today} 的每日额度已重置，跳过。")
+        return False
+    if not sheet_range_has_quota_column():
+        # 读不到 F 列时无法区分自定义额度，重置会把所有人改回默认次数
+        logging.error(f"SHEET_RANGE={SHEET_RANGE} 不包含 F 列（每日额度），拒绝重置每日额度。")
+        return False
+    ensure_user_table()
+    if not user_table_loaded:
+        raise RuntimeError("用户表未加载，无法重置每日额度。")
     service = get_sheets_service()
-    if service:
-        try:
-            result = service.spreadsheets().values().get(spreadsheetId=SHEET_ID, range=SHEET_RANGE).execute()
-            values = result.get('values', [])
-            if values:
-                for i, row in enumerate(values):
-                    if row[0] == str(user_id):
-                        body = {
-                            'value_input_option': 'RAW',
-                            'data': [
-                                {
-                                    'range': f'UserStats!D{i + 2}',  # 假设剩余天数在 D 列
-                                    'values': [[str(remaining_days)]]
-                                }
-                            ]
-                        }
-                        update_result = service.spreadsheets().values().batchUpdate(spreadsheetId=SHEET_ID, body=body).execute()
-                        print(f"update_user_remaining_days API response: {update_result}")
-                        return
-                print(f"警告：找不到用户 ID {user_id} 来更新剩余天数。")
-        except Exception as e:
-            print(f"update_user_remaining_days API error: {e}")
+    if not service:
+        raise RuntimeError("Sheets 服务不可用，无法重置每日额度。")
+    # 持有 flush_lock 期间写回队列不会刷新；在 user_table_lock 内一次完成用户表更新和丢弃旧的 C/D 待写单元格，
+    # 之后的预留都基于重置后的值，写入的单元格排在整列写入之后刷新
+    with write_behind.flush_lock:
+        with user_table_lock:
+            new_values = {user['row']: (user['daily_quota'], max(0, user['remaining_days'] - 1)) for user in user_table.values()}
+            for user in user_table.values():
+                user['daily_limit'], user['remaining_days'] = new_values[user['row']]
+            usage_stats.recount_expiring(user_table.values())
+            write_behind.discard_cells(USER_FIELD_COLUMNS['daily_limit'], USER_FIELD_COLUMNS['remaining_days'])
+            reset_at = time.time()
+        set_meta('daily_reset_at', reset_at)
+        set_meta('daily_reset_date', today)
+        write_reset_values(service, new_values)
+    logging.info(f"{today} 已重置 {len(new_values)} 位用户的每日额度。")
+    return True
+
+
+def write_reset_values(service, new_values):
+    # 连续的行合并为一个范围
+    data = []
+    for row_number in sorted(new_values):
+        values = [str(value) for value in new_values[row_number]]
+        if data and data[-1]['end'] == row_number - 1:
+            data[-1]['end'] = row_number
+            data[-1]['values'].append(values)
+        else:
+            data.append({'start': row_number, 'end': row_number, 'values': [values]})
+    body = {
+        'value_input_option': 'RAW',
+        'data': [{'range': f"UserStats!C{block['start']}:D{block['end']}", 'values': block['values']} for block in data]
+    }
+    try:
+        service.spreadsheets().values().batchUpdate(spreadsheetId=SHEET_ID, body=body).execute()
+    except Exception as e:
+        # 用户表已经重置，改由写回队列重试；期间预留产生的更新值优先
+        write_behind.stats['errors'] += 1
+        logging.error(f"写入每日重置结果时出错，改由写回队列重试: {e}")
+        cells = {}
+        for row_number, (daily_limit, remaining_days) in new_values.items():
+            cells[f"UserStats!{USER_FIELD_COLUMNS['daily_limit']}{row_number}"] = str(daily_limit)
+            cells[f"UserStats!{USER_FIELD_COLUMNS['remaining_days']}{row_number}"] = str(remaining_days)
+        write_behind.requeue(cells, [])
+
+
+async def daily_reset_job(context: CallbackContext):
+    try:
+        await run_sheets(reset_daily_quotas, timeout=SHEETS_CALL_TIMEOUT * 3)
+    except Exception as e:
+        logging.error(f"重置每日额度时出错，{DAILY_RESET_RETRY_SECONDS} 秒后重试: {e}")
+        context.job_queue.run_once(daily_reset_job, when=DAILY_RESET_RETRY_SECONDS)
+
+
+async def catch_up_daily_reset(context: CallbackContext):
+    # 启动时补做错过的 0 点重置（例如 0 点时进程未运行）；今天已重置时 reset_daily_quotas 会跳过。
+    # 本地没有任何重置记录（新部署或状态文件丢失）时无法判断今天是否已重置，交给 0 点的任务处理
+    last_reset = get_meta('daily_reset_date')
+    if last_reset is None:
+        logging.warning("本地没有每日重置记录，跳过启动时的补重置。")
+        return
+    if last_reset != lao_now().strftime('%Y-%m-%d'):
+        logging.info(f"上次每日重置在 {last_reset}，启动时补做今天的重置。")
+        await daily_reset_job(context)
+
+
+def get_meta(key, default=None):
+    db = get_local_db()
+    with local_db_lock:
+        db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        row = db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_meta(key, value):
+    db = get_local_db()
+    with local_db_lock:
+        db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, str(value)))
+        db.commit()
+
+
+def init_history_table(db):
+    with local_db_lock:
+        db.execute('CREATE TABLE IF NOT EXISTS translation_history (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, ts TEXT NOT NULL, original TEXT NOT NULL, translated TEXT NOT NULL, UNIQUE (user_id, ts, original))')
+        db.execute('CREATE INDEX IF NOT EXISTS translation_history_user ON translation_history (user_id, ts)')
+        db.commit()
+
+
+def store_history(records):
+    # 每位用户只保留最近 HISTORY_KEEP 条（环形缓冲）
+    db = get_local_db()
+    init_history_table(db)
+    with local_db_lock:
+        db.executemany('INSERT OR IGNORE INTO translation_history (user_id, ts, original, translated) VALUES (?, ?, ?, ?)', records)
+        for user_id in {record[0] for record in records}:
+            db.execute('DELETE FROM translation_history WHERE user_id = ? AND id NOT IN (SELECT id FROM translation_history WHERE user_id = ? ORDER BY ts DESC, id DESC LIMIT ?)',
+                       (user_id, user_id, HISTORY_KEEP))
+        db.commit()
+
+
+def load_history_page(user_id, page):
+    # 第 1 页为最近的记录；返回 (本页记录（按时间顺序）, 总页数)
+    db = get_local_db()
+    init_history_table(db)
+    with local_db_lock:
+        total = db.execute('SELECT COUNT(*) FROM translation_history WHERE user_id = ?', (user_id,)).fetchone()[0]
+        rows = db.execute('SELECT ts, original, translated FROM translation_history WHERE user_id = ? ORDER BY ts DESC, id DESC LIMIT ? OFFSET ?',
+                          (user_id, HISTORY_PAGE_SIZE, (page - 1) * HISTORY_PAGE_SIZE)).fetchall()
+    return rows[::-1], (total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+
+
+def backfill_history():
+    # 一次性从 TranslationHistory 表导入历史记录，之后 /history 只读本地
+    if get_meta('history_backfilled'):
+        return
+    records = []
+    for row in read_sheet_values(f'{HISTORY_SHEET_NAME}!A2:D'):
+        if len(row) >= 4 and row[0].isdigit():
+            records.append((int(row[0]), row[1], row[2], row[3]))
+    for start in range(0, len(records), 5000):
+        store_history(records[start:start + 5000])
+    set_meta('history_backfilled', lao_now().isoformat())
+    logging.info(f"已从表格导入 {len(records)} 条翻译历史。")
+
+
+async def backfill_history_job(context: CallbackContext):
+    try:
+        await run_sheets(backfill_history, timeout=SHEETS_CALL_TIMEOUT * 10)
+    except Exception as e:
+        logging.error(f"导入翻译历史时出错: {e}")
+
+
+def render_history_page(user_id, page):
+    rows, pages = load_history_page(user_id, page)
+    if not rows:
+        return None, None
+    history_text = "\n".join(f"时间: {ts}\n原文: {original}\n译文: {translated}\n------------------" for ts, original, translated in rows)
+    buttons = []
+    if page < pages:
+        buttons.append(InlineKeyboardButton('⬅️ 更早', callback_data=f'history:{page + 1}'))
+    if page > 1:
+        buttons.append(InlineKeyboardButton('更近 ➡️', callback_data=f'history:{page - 1}'))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return f"您的翻译历史（第 {page}/{pages} 页）:\n\n{history_text}", reply_markup
 
 
 async def history(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    service = get_sheets_service()
-    if service:
-        history_sheet_name = 'TranslationHistory'
-        range_name = f'{history_sheet_name}!A2:D'
-        try:
-            result = service.spreadsheets().values().get(spreadsheetId=SHEET_ID, range=range_name).execute()
-            values = result.get('values', [])
-            history_records = []
-            if values:
-                # 跳过标题行（如果存在）
-                for row in values:
-                    if row and row[0] == str(user_id):
-                        history_records.append(f"时间: {row[1]}\n原文: {row[2]}\n译文: {row[3]}\n------------------")
-            if history_records:
-                history_text = "\n".join(history_records[-10:])  # 显示最近 10 条
-                await context.bot.send_message(chat_id=update.effective_chat.id, text=f"您的最近翻译历史 (最多 10 条):\n\n{history_text}")
-            else:
-                await context.bot.send_message(chat_id=update.effective_chat.id, text="您还没有任何翻译历史记录。")
-        except Exception as e:
-            logging.error(f"/history 命令出错: {e}")
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="获取翻译历史时出错，请稍后再试。")
+    page = int(context.args[0]) if context.args and context.args[0].isdigit() and int(context.args[0]) > 0 else 1
+    try:
+        text, reply_markup = await run_local_db(render_history_page, user_id, page)
+        if text:
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=text, reply_markup=reply_markup)
+        else:
+            await context.bot.send_message(chat_id=update.effective_chat.id, text="您还没有任何翻译历史记录。")
+    except Exception as e:
+        logging.error(f"/history 命令出错: {e}")
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="获取翻译历史时出错，请稍后再试。")
+
+
+async def history_page_callback(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
+    page = int(query.data.split(':')[1])
+    text, reply_markup = await run_local_db(render_history_page, update.effective_user.id, page)
+    if text:
+        await query.edit_message_text(text=text, reply_markup=reply_markup)
 
 
 async def profile(update: Update, context: CallbackContext):
     user = update.effective_user
     user_id = user.id
-    user_info = get_user_info(user_id)
+    user_info = await get_user_info(user_id)
     if user_info:
         profile_text = f"**您的个人资料**\n\n用户ID: `{user_info['user_id']}`\n用户名: `{user_info['username']}`\n今日剩余翻译次数: `{user_info['daily_limit']}`\n剩余天数: `{user_info['remaining_days']}`\n加入日期: `{user_info['join_date']}`"
         await context.bot.send_message(chat_id=update.effective_chat.id, text=profile_text, parse_mode=telegram.constants.ParseMode.MARKDOWN)
@@ -273,51 +1507,89 @@ async def profile(update: Update, context: CallbackContext):
 
 async def feedback(update: Update, context: CallbackContext):
     await context.bot.send_message(chat_id=update.effective_chat.id, text="请发送您的反馈或建议。")
-    context.user_data['expecting_feedback'] = True
+    context.chat_data['state'] = 'feedback'
 
 
 async def handle_feedback_message(update: Update, context: CallbackContext):
-    if context.user_data.get('expecting_feedback'):
-        user = update.effective_user
-        feedback_text = update.message.text
-        # 这里可以将反馈发送给管理员或者保存到 Google Sheets
-        admin_chat_id = GROUP_ID  # 假设将反馈发送到你的群组
-        feedback_message = f"**新反馈：**\n用户ID: `{user.id}`\n用户名: `{user.username}`\n内容:\n{feedback_text}"
-        try:
-            await context.bot.send_message(chat_id=admin_chat_id, text=feedback_message, parse_mode=telegram.constants.ParseMode.MARKDOWN)
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="感谢您的反馈！")
-        except Exception as e:
-            logging.error(f"发送反馈给管理员时出错: {e}")
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="发送反馈时出错，请稍后再试。")
-        finally:
-            context.user_data['expecting_feedback'] = False
+    user = update.effective_user
+    feedback_text = update.message.text
+    # 这里可以将反馈发送给管理员或者保存到 Google Sheets
+    admin_chat_id = GROUP_ID  # 假设将反馈发送到你的群组
+    feedback_message = f"**新反馈：**\n用户ID: `{user.id}`\n用户名: `{user.username}`\n内容:\n{feedback_text}"
+    try:
+        await context.bot.send_message(chat_id=admin_chat_id, text=feedback_message, parse_mode=telegram.constants.ParseMode.MARKDOWN)
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="感谢您的反馈！")
+    except Exception as e:
+        logging.error(f"发送反馈给管理员时出错: {e}")
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="发送反馈时出错，请稍后再试。")
+
+
+def render_user_page(page):
+    with user_table_lock:
+        users = sorted(user_table.values(), key=lambda u: u['row'])
+    pages = max(1, (len(users) + STATS_PAGE_SIZE - 1) // STATS_PAGE_SIZE)
+    page = min(max(page, 1), pages)
+    lines = [f"**用户列表（第 {page}/{pages} 页）：**"]
+    lines.extend(f"用户ID: `{u['user_id']}`, 剩余次数: `{u['daily_limit']}`, 剩余天数: `{u['remaining_days']}`"
+                 for u in users[(page - 1) * STATS_PAGE_SIZE:page * STATS_PAGE_SIZE])
+    buttons = []
+    if page > 1:
+        buttons.append(InlineKeyboardButton('⬅️ 上一页', callback_data=f'stats:{page - 1}'))
+    if page < pages:
+        buttons.append(InlineKeyboardButton('下一页 ➡️', callback_data=f'stats:{page + 1}'))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons, [InlineKeyboardButton('📊 返回统计', callback_data='stats:0')]])
+
+
+def render_stats_summary(pool):
+    text = "\n".join([
+        "**用户统计：**",
+        usage_stats.summary(),
+        "",
+        translation_cache.summary(),
+        singleflight_summary(),
+        write_behind.summary(),
+        pool.summary(),
+    ])
+    return text, InlineKeyboardMarkup([[InlineKeyboardButton('👥 用户列表', callback_data='stats:1')]])
 
 
 async def admin_stats(update: Update, context: CallbackContext):
     user = update.effective_user
     if user.id in ADMIN_IDS:
-        service = get_sheets_service()
-        if service:
-            range_name = f'{SHEET_RANGE.split("!")[0]}!A2:D'  # 获取用户 ID 和剩余次数
-            try:
-                result = service.spreadsheets().values().get(spreadsheetId=SHEET_ID, range=range_name).execute()
-                values = result.get('values', [])
-                if values:
-                    stats_text = "**用户统计：**\n"
-                    for row in values:
-                        if row:
-                            user_id = row[0]
-                            translations_left = row[2] if len(row) > 2 else 'N/A'
-                            remaining_days = row[3] if len(row) > 3 else 'N/A'
-                            stats_text += f"用户ID: `{user_id}`, 剩余次数: `{translations_left}`, 剩余天数: `{remaining_days}`\n"
-                    await context.bot.send_message(chat_id=update.effective_chat.id, text=stats_text, parse_mode=telegram.constants.ParseMode.MARKDOWN)
-                else:
-                    await context.bot.send_message(chat_id=update.effective_chat.id, text="没有找到任何用户数据。")
-            except Exception as e:
-                logging.error(f"/admin_stats 命令出错: {e}")
-                await context.bot.send_message(chat_id=update.effective_chat.id, text="获取用户统计时出错。")
+        try:
+            if not user_table_loaded:
+                await run_sheets(load_user_table)
+            text, reply_markup = render_stats_summary(await get_gemini_pool_async())
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=text, reply_markup=reply_markup, parse_mode=telegram.constants.ParseMode.MARKDOWN)
+        except Exception as e:
+            logging.error(f"/admin_stats 命令出错: {e}")
+            await context.bot.send_message(chat_id=update.effective_chat.id, text="获取用户统计时出错。")
+    else:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="您没有权限执行此命令。")
+
+
+async def admin_stats_callback(update: Update, context: CallbackContext):
+    query = update.callback_query
+    if update.effective_user.id not in ADMIN_IDS:
+        await query.answer("您没有权限执行此操作。")
+        return
+    await query.answer()
+    page = int(query.data.split(':')[1])
+    text, reply_markup = render_user_page(page) if page else render_stats_summary(await get_gemini_pool_async())
+    await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=telegram.constants.ParseMode.MARKDOWN)
+
+async def admin_refresh_users(update: Update, context: CallbackContext):
+    if update.effective_user.id in ADMIN_IDS:
+        if await run_sheets(load_user_table):
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=f"用户表已重新加载，共 {len(user_table)} 位用户。")
         else:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="无法连接到 Google Sheets。")
+            await context.bot.send_message(chat_id=update.effective_chat.id, text="重新加载用户表失败。")
+    else:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="您没有权限执行此命令。")
+
+async def admin_token_stats(update: Update, context: CallbackContext):
+    if update.effective_user.id in ADMIN_IDS:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=(await get_gemini_pool_async()).token_summary())
     else:
         await context.bot.send_message(chat_id=update.effective_chat.id, text="您没有权限执行此命令。")
 
@@ -325,118 +1597,707 @@ async def admin_set_limit(update: Update, context: CallbackContext, user_id: int
     print(f"Admin {update.effective_user.id} setting limit {new_limit} for user {user_id}")
     await context.bot.send_message(chat_id=update.effective_chat.id, text=f"已为用户 {user_id} 设置每日使用次数为 {new_limit}。")
 
-    service = get_sheets_service()
-    if service:
-        logging.info(f"admin_set_limit - SHEET_ID: {SHEET_ID}")
-        logging.info(f"admin_set_limit - SHEET_RANGE: {SHEET_RANGE}")
-        try:
-            result = service.spreadsheets().values().get(spreadsheetId=SHEET_ID, range=SHEET_RANGE).execute()
-            values = result.get('values', [])
-            if values:
-                for i, row in enumerate(values):
-                    if row[0] == str(user_id):
-                        body = {
-                            'value_input_option': 'RAW',
-                            'data': [
-                                {
-                                    'range': f'UserStats!C{i + 2}', # 假设次数在 C 列，从第二行开始
-                                    'values': [[str(new_limit)]]
-                                }
-                            ]
-                        }
-                        update_result = service.spreadsheets().values().batchUpdate(spreadsheetId=SHEET_ID, body=body).execute()
-                        print(f"admin_set_limit API response: {update_result}")
-                        return
-                print(f"警告：找不到用户 ID {user_id} 来更新每日限制。")
-        except Exception as e:
-            print(f"admin_set_limit API error: {e}")
+    await run_sheets(ensure_user_table)
+    update_user_daily_limit(user_id, new_limit)
+    update_user_field(user_id, 'daily_quota', new_limit)  # 之后每天重置为该次数
 
 async def admin_set_days(update: Update, context: CallbackContext, user_id: int, new_days: int):
     print(f"Admin {update.effective_user.id} setting days {new_days} for user {user_id}")
     await context.bot.send_message(chat_id=update.effective_chat.id, text=f"已为用户 {user_id} 设置剩余天数为 {new_days}。")
 
-    service = get_sheets_service()
-    if service:
-        logging.info(f"admin_set_days - SHEET_ID: {SHEET_ID}")
-        logging.info(f"admin_set_days - SHEET_RANGE: {SHEET_RANGE}")
+    await run_sheets(ensure_user_table)
+    update_user_remaining_days(user_id, new_days)
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+
+
+def init_broadcast_tables(db):
+    with local_db_lock:
+        db.execute('CREATE TABLE IF NOT EXISTS blocked_users (user_id INTEGER PRIMARY KEY, blocked_at REAL NOT NULL)')
+        db.execute('CREATE TABLE IF NOT EXISTS broadcasts (id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL, parse_mode TEXT, admin_chat_id INTEGER, status TEXT NOT NULL, created_at REAL NOT NULL)')
+        db.execute('CREATE TABLE IF NOT EXISTS broadcast_targets (broadcast_id INTEGER NOT NULL, user_id INTEGER NOT NULL, status TEXT NOT NULL, PRIMARY KEY (broadcast_id, user_id))')
+        db.commit()
+
+
+def get_blocked_users():
+    global blocked_users
+    if blocked_users is None:
+        db = get_local_db()
+        init_broadcast_tables(db)
+        with local_db_lock:
+            blocked_users = {row[0] for row in db.execute('SELECT user_id FROM blocked_users')}
+    return blocked_users
+
+
+def mark_user_blocked(user_id):
+    get_blocked_users().add(user_id)
+    db = get_local_db()
+    with local_db_lock:
+        db.execute('INSERT OR REPLACE INTO blocked_users VALUES (?, ?)', (user_id, time.time()))
+        db.commit()
+
+
+def create_broadcast(text, user_ids, parse_mode=None, admin_chat_id=None):
+    # 广播任务和收件人状态写入本地数据库，进程重启后可以继续发送
+    blocked = get_blocked_users()
+    db = get_local_db()
+    with local_db_lock:
+        cursor = db.execute('INSERT INTO broadcasts (text, parse_mode, admin_chat_id, status, created_at) VALUES (?, ?, ?, ?, ?)',
+                            (text, parse_mode, admin_chat_id, 'running', time.time()))
+        broadcast_id = cursor.lastrowid
+        db.executemany('INSERT OR IGNORE INTO broadcast_targets VALUES (?, ?, ?)',
+                       [(broadcast_id, user_id, 'pending') for user_id in user_ids if user_id not in blocked])
+        db.commit()
+    return broadcast_id
+
+
+def retry_after_seconds(error):
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, datetime.timedelta) else float(retry_after)
+
+
+async def acquire_broadcast_slot():
+    while True:
+        wait = broadcast_bucket.try_acquire()
+        if not wait:
+            return
+        await asyncio.sleep(wait)
+
+
+async def send_broadcast_message(bot, user_id, text, parse_mode):
+    # 返回 'sent'、'blocked' 或 'failed'
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        await acquire_broadcast_slot()
         try:
-            result = service.spreadsheets().values().get(spreadsheetId=SHEET_ID, range=SHEET_RANGE).execute()
-            values = result.get('values', [])
-            if values:
-                for i, row in enumerate(values):
-                    if row[0] == str(user_id):
-                        body = {
-                            'value_input_option': 'RAW',
-                            'data': [
-                                {
-                                    'range': f'UserStats!D{i + 2}', # 假设剩余天数在 D 列，从第二行开始
-                                    'values': [[str(new_days)]]
-                                }
-                            ]
-                        }
-                        update_result = service.spreadsheets().values().batchUpdate(spreadsheetId=SHEET_ID, body=body).execute()
-                        print(f"admin_set_days API response: {update_result}")
-                        return
-                print(f"警告：找不到用户 ID {user_id} 来更新剩余天数。")
-        except Exception as e:
-            print(f"admin_set_days API error: {e}")
+            await bot.send_message(chat_id=user_id, text=text, parse_mode=parse_mode)
+            return 'sent'
+        except telegram.error.RetryAfter as e:
+            await asyncio.sleep(retry_after_seconds(e))
+        except telegram.error.Forbidden:
+            mark_user_blocked(user_id)
+            return 'blocked'
+        except telegram.error.BadRequest as e:
+            # BadRequest 是 NetworkError 的子类，但属于永久错误（消息格式错误、找不到聊天等），重试无用
+            logging.error(f"向用户 {user_id} 发送广播消息失败: {e}")
+            return 'failed'
+        except telegram.error.NetworkError as e:
+            logging.warning(f"向用户 {user_id} 发送广播失败（第 {attempt + 1} 次）: {e}")
+            await asyncio.sleep(2 ** attempt)
+        except telegram.error.TelegramError as e:
+            logging.error(f"向用户 {user_id} 发送广播消息失败: {e}")
+            return 'failed'
+    return 'failed'
+
+
+async def run_broadcast(bot, broadcast_id):
+    db = get_local_db()
+    with local_db_lock:
+        text, parse_mode, admin_chat_id = db.execute('SELECT text, parse_mode, admin_chat_id FROM broadcasts WHERE id = ?', (broadcast_id,)).fetchone()
+        counts = dict(db.execute('SELECT status, COUNT(*) FROM broadcast_targets WHERE broadcast_id = ? GROUP BY status', (broadcast_id,)).fetchall())
+        pending = [row[0] for row in db.execute("SELECT user_id FROM broadcast_targets WHERE broadcast_id = ? AND status = 'pending'", (broadcast_id,))]
+    total = sum(counts.values())
+    counters = {status: counts.get(status, 0) for status in ('sent', 'blocked', 'failed')}
+    queue = deque(pending)
+    results = []  # 尚未写入数据库的 (状态, user_id)
+
+    async def worker():
+        while queue:
+            user_id = queue.popleft()
+            status = await send_broadcast_message(bot, user_id, text, parse_mode)
+            counters[status] += 1
+            results.append((status, broadcast_id, user_id))
+
+    def save_results():
+        batch = results[:]
+        del results[:]
+        with local_db_lock:
+            db.executemany('UPDATE broadcast_targets SET status = ? WHERE broadcast_id = ? AND user_id = ?', batch)
+            db.commit()
+
+    def progress_text(done):
+        finished = counters['sent'] + counters['blocked'] + counters['failed']
+        head = "广播完成" if done else "广播发送中"
+        return f"{head}：{finished}/{total}，成功 {counters['sent']}，屏蔽 {counters['blocked']}，失败 {counters['failed']}"
+
+    progress_message = None
+    if admin_chat_id:
+        try:
+            progress_message = await bot.send_message(chat_id=admin_chat_id, text=progress_text(False))
+        except telegram.error.TelegramError as e:
+            logging.warning(f"发送广播进度失败: {e}")
+    workers = [asyncio.create_task(worker()) for _ in range(min(BROADCAST_WORKERS, len(pending)))]
+    shown = None
+    while True:
+        if workers:
+            _, pending_workers = await asyncio.wait(workers, timeout=BROADCAST_PROGRESS_INTERVAL)
+            workers = list(pending_workers)
+        save_results()
+        text_now = progress_text(not workers)
+        if progress_message and text_now != shown:
+            try:
+                await progress_message.edit_text(text_now)
+                shown = text_now
+            except telegram.error.TelegramError as e:
+                logging.warning(f"更新广播进度失败: {e}")
+        if not workers:
+            break
+    with local_db_lock:
+        db.execute("UPDATE broadcasts SET status = 'done' WHERE id = ?", (broadcast_id,))
+        db.commit()
+    if admin_chat_id and not progress_message:
+        await bot.send_message(chat_id=admin_chat_id, text=progress_text(True))
+    logging.info(f"广播 {broadcast_id} 完成: {counters}")
+    return counters
+
+
+async def resume_broadcasts(application):
+    # 进程重启后继续发送尚未完成的广播
+    db = get_local_db()
+    init_broadcast_tables(db)
+    with local_db_lock:
+        broadcast_ids = [row[0] for row in db.execute("SELECT id FROM broadcasts WHERE status = 'running'")]
+    for broadcast_id in broadcast_ids:
+        logging.info(f"继续未完成的广播 {broadcast_id}")
+        run_in_background(run_broadcast(application.bot, broadcast_id))
+
 
 async def admin_broadcast(update: Update, context: CallbackContext, broadcast_message=None):
     user = update.effective_user
     if user.id in ADMIN_IDS:
         if broadcast_message:
             message = broadcast_message[0]
-            user_ids = get_all_user_ids()
-            sent_count = 0
-            failed_count = 0
-            for user_id in user_ids:
-                try:
-                    await context.bot.send_message(chat_id=user_id, text=f"**管理员广播：**\n{message}", parse_mode=telegram.constants.ParseMode.MARKDOWN)
-                    sent_count += 1
-                    time.sleep(0.1) # 避免过于频繁发送
-                except Exception as e:
-                    logging.error(f"向用户 {user_id} 发送广播消息失败: {e}")
-                    failed_count += 1
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=f"广播消息已发送给 {sent_count} 位用户，{failed_count} 位发送失败。")
+            user_ids = await run_sheets(get_all_user_ids)
+            broadcast_id = create_broadcast(f"**管理员广播：**\n{message}", user_ids, telegram.constants.ParseMode.MARKDOWN, update.effective_chat.id)
+            # 在后台发送，进度消息会实时更新
+            run_in_background(run_broadcast(context.bot, broadcast_id))
         else:
             await context.bot.send_message(chat_id=update.effective_chat.id, text="用法: 请在点击“发送广播”后直接输入要发送的消息。")
     else:
         await context.bot.send_message(chat_id=update.effective_chat.id, text="您没有权限执行此命令。")
 
+def get_local_db():
+    global local_db
+    with local_db_lock:
+        if local_db is None:
+            local_db = sqlite3.connect(LOCAL_DB_PATH, check_same_thread=False)
+            local_db.execute('PRAGMA journal_mode=WAL')
+        return local_db
+
+
+def normalize_text(text):
+    # 全角转半角、去掉空白，使同一短语的不同写法命中同一缓存
+    text = unicodedata.normalize('NFKC', text)
+    return re.sub(r'\s+', '', text).lower()
+
+
+class TranslationCache:
+    # 内存 LRU + SQLite 持久化的翻译结果缓存，按 TTL 和条数淘汰
+    def __init__(self, size, max_rows, ttl):
+        self.size = size
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.memory = OrderedDict()  # key -> (body, history_text, created_at)
+        self.lock = threading.Lock()
+        self.db_ready = False
+        self.puts_since_prune = 0
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'puts': 0, 'evictions': 0}
+
+    @staticmethod
+    def make_key(user_text, model_name):
+        raw = f"{PROMPT_VERSION}|{model_name}|{normalize_text(user_text)}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def _db(self):
+        db = get_local_db()
+        if not self.db_ready:
+            with local_db_lock:
+                db.execute('CREATE TABLE IF NOT EXISTS translation_cache (key TEXT PRIMARY KEY, body TEXT NOT NULL, history_text TEXT NOT NULL, created_at REAL NOT NULL, last_hit REAL NOT NULL)')
+                db.execute('CREATE INDEX IF NOT EXISTS translation_cache_last_hit ON translation_cache (last_hit)')
+                db.commit()
+            self.db_ready = True
+        return db
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry and now - entry[2] < self.ttl:
+                self.memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                metrics.inc('translation_cache_lookups_total', result='memory_hit')
+                return entry[0], entry[1]
+            self.memory.pop(key, None)
+        try:
+            db = self._db()
+            with local_db_lock:
+                row = db.execute('SELECT body, history_text, created_at FROM translation_cache WHERE key = ?', (key,)).fetchone()
+                if row and now - row[2] < self.ttl:
+                    db.execute('UPDATE translation_cache SET last_hit = ? WHERE key = ?', (now, key))
+                    db.commit()
+        except sqlite3.Error as e:
+            logging.error(f"读取翻译缓存出错: {e}")
+            row = None
+        with self.lock:
+            if row and now - row[2] < self.ttl:
+                self._remember(key, row)
+                self.stats['disk_hits'] += 1
+                metrics.inc('translation_cache_lookups_total', result='disk_hit')
+                return row[0], row[1]
+            self.stats['misses'] += 1
+        metrics.inc('translation_cache_lookups_total', result='miss')
+        return None
+
+    def put(self, key, body, history_text):
+        now = time.time()
+        with self.lock:
+            self._remember(key, (body, history_text, now))
+            self.stats['puts'] += 1
+            self.puts_since_prune += 1
+            prune = self.puts_since_prune >= 100
+            if prune:
+                self.puts_since_prune = 0
+        try:
+            db = self._db()
+            with local_db_lock:
+                db.execute('INSERT OR REPLACE INTO translation_cache VALUES (?, ?, ?, ?, ?)', (key, body, history_text, now, now))
+                if prune:
+                    self._prune(db, now)
+                db.commit()
+        except sqlite3.Error as e:
+            logging.error(f"写入翻译缓存出错: {e}")
+
+    def _prune(self, db, now):
+        # 删除过期条目，并按最近命中时间淘汰超出上限的条目
+        db.execute('DELETE FROM translation_cache WHERE created_at < ?', (now - self.ttl,))
+        db.execute('DELETE FROM translation_cache WHERE key IN (SELECT key FROM translation_cache ORDER BY last_hit DESC LIMIT -1 OFFSET ?)', (self.max_rows,))
+
+    def summary(self):
+        hits = self.stats['memory_hits'] + self.stats['disk_hits']
+        total = hits + self.stats['misses']
+        rate = hits * 100 / total if total else 0
+        return f"翻译缓存：命中 {hits}（内存 {self.stats['memory_hits']} / 磁盘 {self.stats['disk_hits']}），未命中 {self.stats['misses']}，命中率 {rate:.1f}%，内存条目 {len(self.memory)}"
+
+
+translation_cache = TranslationCache(TRANSLATION_CACHE_SIZE, TRANSLATION_CACHE_MAX_ROWS, TRANSLATION_CACHE_TTL)
+
+
+# 结构化输出：字段名 -> 回复中的标题，按回复中的顺序排列
+TRANSLATION_FIELDS = [('translation', '🇱🇦正文：'), ('pronunciation', '️发音：'), ('homophonic', '🇨🇳谐音：'), ('analysis', '中文词语分析：')]
+TranslationResult = namedtuple('TranslationResult', [field for field, _ in TRANSLATION_FIELDS])
+TRANSLATION_GENERATION_CONFIG = {
+    'response_mime_type': 'application/json',
+    'response_schema': {
+        'type': 'OBJECT',
+        'properties': {
+            'translation': {'type': 'STRING', 'description': '完整的老挝语译文'},
+            'pronunciation': {'type': 'STRING', 'description': '老挝语译文的拉丁字母发音'},
+            'homophonic': {'type': 'STRING', 'description': '老挝语发音的纯汉字谐音，只包含汉字'},
+            'analysis': {'type': 'STRING', 'description': '中文词语分析，每行一条，格式：中文词语：老挝词语 （纯汉字谐音）'},
+        },
+        'required': ['translation', 'pronunciation', 'homophonic', 'analysis'],
+    },
+}
+
+
+TRANSLATION_FIELD_INSTRUCTIONS = "translation：完整翻译\npronunciation：发音（内容用拉丁语）\nhomophonic：纯汉字谐音\nanalysis：中文词语分析（中文词语：老挝词语 （纯汉字谐音），每行一条）"
+# 各类请求不变的说明，作为每个模型客户端的 system_instruction（修改后递增 PROMPT_VERSION）
+SYSTEM_INSTRUCTIONS = {
+    'translate': f"你是中文到老挝语的翻译。将用户发送的中文文本翻译成老挝语，并用拉丁语展示老挝语的发音，返回中文注释、老挝语发音和纯汉字谐音。只返回一个 JSON 对象，包含以下字段：\n{TRANSLATION_FIELD_INSTRUCTIONS}",
+    'translate_batch': f"你是中文到老挝语的翻译。用户会发送编号的多段中文文本，请逐段翻译成老挝语，并用拉丁语展示老挝语的发音，返回中文注释、老挝语发音和纯汉字谐音。只返回一个 JSON 数组，按原顺序每段一个对象，每个对象包含以下字段：\n{TRANSLATION_FIELD_INSTRUCTIONS}",
+    'vocabulary': "根据用户给出的分类随机生成 1 个老挝语词汇或句子，并提供中文翻译和拉丁语发音。格式：中文：老挝语（谐音用汉语拼音）。不要使用用户列出的已用词汇/句子。",
+}
+
+
+def build_translation_prompt(user_text):
+    return f"中文文本：{user_text}"
+
+
+JSON_STRING_FIELD = re.compile(r'"(\w+)"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def parse_translation_json(translation):
+    # 单次解析结构化输出；不是合法 JSON 时返回 None
+    start = translation.find('{')
+    end = translation.rfind('}')
+    if start < 0 or end < start:
+        return None
+    try:
+        data = json.loads(translation[start:end + 1])
+    except ValueError:
+        return None
+    return translation_result_from_dict(data)
+
+
+def translation_result_from_dict(data):
+    if not isinstance(data, dict) or not data.get('translation'):
+        return None
+    return TranslationResult(*(str(data.get(field) or '').strip() or None for field in TranslationResult._fields))
+
+
+def parse_translation_regex(translation):
+    # 旧的文本格式解析，模型没有按 JSON 返回时使用
+    translation = re.sub(r'纯汉字谐音：(.*?)\n', lambda x: '纯汉字谐音：' + re.sub(r"[^\u4e00-\u9fa5]", "", x.group(1)) + '\n', translation)
+
+    full_translation = re.search(r'完整翻译：(.*?)发音：', translation, re.DOTALL)
+    latin_pronunciation = re.search(r'发音：(.*?)纯汉字谐音：', translation, re.DOTALL)
+    chinese_homophonic = re.search(r'纯汉字谐音：(.*?)中文词语分析：', translation, re.DOTALL)
+    word_analysis = re.search(r'中文词语分析：(.*)', translation, re.DOTALL)
+    return TranslationResult(*(match.group(1).strip() if match else None for match in (full_translation, latin_pronunciation, chinese_homophonic, word_analysis)))
+
+
+def parse_translation(translation):
+    return parse_translation_json(translation) or parse_translation_regex(translation)
+
+
+TRANSLATION_MISSING = ['翻译结果未找到', '拉丁发音结果未找到', '谐音结果未找到', '词语分析结果未找到']
+
+
+def render_translation_fields(result):
+    # 按 TRANSLATION_FIELDS 的顺序返回各字段清理后的文本，缺失的字段为 None
+    return [
+        clean_text(result.translation.replace('。', '\n')) if result.translation else None,
+        clean_text(result.pronunciation.replace('。', '\n')) if result.pronunciation else None,
+        clean_text(re.sub(r"[^\u4e00-\u9fa5\n]", "", result.homophonic)) if result.homophonic else None,
+        clean_text(result.analysis) if result.analysis else None,
+    ]
+
+
+def render_translation(result):
+    # 返回 (不含剩余次数的回复正文, 写入历史的译文)；解析失败时译文为 None
+    texts = render_translation_fields(result)
+    sections = (f"{label}\n{text or missing}" for (_, label), text, missing in zip(TRANSLATION_FIELDS, texts, TRANSLATION_MISSING))
+    return "----------------------------\n" + "\n\n".join(sections), texts[0]
+
+
+def format_translation(translation):
+    return render_translation(parse_translation(translation))
+
+
+# (模型输出中的段落标题, 回复中的标题)，按输出顺序排列
+TRANSLATION_SECTIONS = [('完整翻译：', '🇱🇦正文：'), ('发音：', '️发音：'), ('纯汉字谐音：', '🇨🇳谐音：'), ('中文词语分析：', '中文词语分析：')]
+
+
+def format_partial_translation(translation):
+    # 流式输出时只展示已经完整的段落
+    if translation.lstrip().startswith(('{', '`')):
+        # JSON：字符串字段的结束引号出现即为完整。JSON 模式下 Gemini 按字段名字母顺序输出
+        # （0.8 版 SDK 的 Schema 无法设置 propertyOrdering），所以不依赖输出顺序，展示所有已完整的字段
+        fields = {}
+        for name, value in JSON_STRING_FIELD.findall(translation):
+            try:
+                fields[name] = json.loads(f'"{value}"')
+            except ValueError:
+                fields[name] = value
+        result = TranslationResult(*(fields.get(field) for field, _ in TRANSLATION_FIELDS))
+    else:
+        # 文本格式：下一段标题已经出现的段落即为完整
+        position = 0
+        completed = 0
+        for header, _ in TRANSLATION_SECTIONS:
+            index = translation.find(header, position)
+            if index < 0:
+                break
+            completed += 1
+            position = index + len(header)
+        completed -= 1  # 最后出现的标题对应的段落可能还没有生成完
+        if completed <= 0:
+            return None
+        result = parse_translation_regex(translation[:position])
+    texts = render_translation_fields(result)
+    if all(texts) or not any(texts):
+        return None
+    sections = (f"{label}\n{text}" for (_, label), text in zip(TRANSLATION_FIELDS, texts) if text)
+    return "----------------------------\n" + "\n\n".join(sections) + '\n\n⏳ 正在生成…'
+
+
+BATCH_TRANSLATION_GENERATION_CONFIG = {
+    'response_mime_type': 'application/json',
+    'response_schema': {'type': 'ARRAY', 'items': TRANSLATION_GENERATION_CONFIG['response_schema']},
+}
+SENTENCE_PIECE = re.compile(r'[^。！？!?；;…\n]*[。！？!?；;…\n]+|[^。！？!?；;…\n]+')
+CLAUSE_PIECE = re.compile(r'[^，,、：:]*[，,、：:]+|[^，,、：:]+')
+
+
+def split_segments(text, limit=LONG_TEXT_SEGMENT_CHARS):
+    # 在句末标点处断句，过长的句子再在逗号处断开，仍然过长的按字数切开；
+    # 然后把相邻的短句合并，每段不超过 limit 字
+    pieces = []
+    for sentence in SENTENCE_PIECE.findall(text):
+        sentence = sentence.strip()
+        if len(sentence) <= limit:
+            pieces.append(sentence)
+            continue
+        for clause in CLAUSE_PIECE.findall(sentence):
+            pieces.extend(clause[i:i + limit] for i in range(0, len(clause), limit))
+    segments = []
+    for piece in pieces:
+        if not piece:
+            continue
+        if segments and len(segments[-1]) + len(piece) <= limit:
+            segments[-1] += piece
+        else:
+            segments.append(piece)
+    return segments
+
+
+def build_batch_translation_prompt(segments):
+    numbered = "\n".join(f"{i + 1}. {segment}" for i, segment in enumerate(segments))
+    return f"共 {len(segments)} 段中文文本：\n{numbered}"
+
+
+def parse_batch_translation(translation, count):
+    # 解析逐段翻译的 JSON 数组；不是合法 JSON 或段数不一致时返回 None
+    start = translation.find('[')
+    end = translation.rfind(']')
+    if start < 0 or end < start:
+        return None
+    try:
+        data = json.loads(translation[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(data, list) or len(data) != count:
+        return None
+    return [translation_result_from_dict(item) for item in data]
+
+
+async def translate_segment(segment):
+    try:
+        pool = await get_gemini_pool_async()
+        response = await pool.generate_async(build_translation_prompt(segment), task='translate', generation_config=TRANSLATION_GENERATION_CONFIG)
+        return parse_translation(response.text)
+    except Exception as e:
+        logging.error(f"长文本分段翻译出错: {e}")
+        return None
+
+
+async def translate_batch(segments):
+    # 一次调用翻译多段；结果无法按段对应时改为逐段并行翻译
+    if len(segments) > 1:
+        try:
+            pool = await get_gemini_pool_async()
+            response = await pool.generate_async(build_batch_translation_prompt(segments), task='translate_batch', generation_config=BATCH_TRANSLATION_GENERATION_CONFIG)
+            results = parse_batch_translation(response.text, len(segments))
+            if results is not None:
+                return results
+            logging.warning(f"批量翻译结果无法按 {len(segments)} 段解析，改为逐段翻译。")
+        except Exception as e:
+            logging.error(f"批量翻译出错，改为逐段翻译: {e}")
+    return await asyncio.gather(*(translate_segment(segment) for segment in segments))
+
+
+async def translate_segments(segments):
+    # 各批次并行发送，并发数由 Gemini 客户端池限制；按原顺序返回每段的结果（失败的段为 None）
+    batches = [segments[i:i + LONG_TEXT_BATCH_SEGMENTS] for i in range(0, len(segments), LONG_TEXT_BATCH_SEGMENTS)]
+    results = await asyncio.gather(*(translate_batch(batch) for batch in batches))
+    return [result for batch in results for result in batch]
+
+
+def merge_translations(results):
+    # 把各段结果按段落顺序拼接成一个结果，失败的段在正文中标出
+    merged = {field: [] for field in TranslationResult._fields}
+    for i, result in enumerate(results):
+        if result is None or not result.translation:
+            merged['translation'].append(f"（第 {i + 1} 段翻译失败）")
+            continue
+        for field in TranslationResult._fields:
+            value = getattr(result, field)
+            if value:
+                merged[field].append(value)
+    return TranslationResult(*("\n".join(merged[field]) or None for field in TranslationResult._fields))
+
+
+def is_vip_user(user_id, user_info):
+    # VIP_USER_IDS 中的用户以及每日额度高于默认值的用户可以使用长文本模式
+    # （管理员的文字消息由管理操作处理，不会进入翻译）
+    return user_id in VIP_USER_IDS or (user_info or {}).get('daily_quota', DEFAULT_DAILY_LIMIT) > DEFAULT_DAILY_LIMIT
+
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    # 按行把超长回复拆成多条消息
+    parts = []
+    current = ''
+    for line in text.split('\n'):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ''
+            parts.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            parts.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        parts.append(current)
+    return parts
+
+
+async def translate_long_text(update, context, user_id, user_info, user_text):
+    # 长文本按段计费：先预留全部分段的额度，翻译失败的段退还
+    segments = split_segments(user_text)
+    status, daily_limit, remaining_days = quota_ledger.reserve(user_id, user_info, len(segments))
+    if status == 'no_days':
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="您的试用天数已用完，升级为vip用户体验更完美")
+        return
+    if status == 'no_quota':
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"这段文字共 {len(segments)} 段，需要 {len(segments)} 次翻译额度，今日剩余 {daily_limit} 次。")
+        return
+    try:
+        sent_message = await context.bot.send_message(chat_id=update.effective_chat.id, text=f"⏳ 正在翻译长文本（共 {len(segments)} 段）…", reply_to_message_id=update.message.message_id)
+        results = await translate_segments(segments)
+        # 按段计数，与短文本的单次翻译可比，/tokens 的平均值不被长文本拉高
+        (await get_gemini_pool_async()).translations += len(segments)
+    except Exception:
+        quota_ledger.refund(user_id, len(segments))
+        raise
+    failed = sum(1 for result in results if result is None or not result.translation)
+    if failed:
+        quota_ledger.refund(user_id, failed)
+        daily_limit += failed
+    if failed < len(segments):
+        quota_ledger.commit(user_id, len(segments) - failed)
+
+    body, history_text = render_translation(merge_translations(results))
+    parts = split_message(body + quota_footer(daily_limit, remaining_days))
+    await sent_message.edit_text(parts[0])
+    for part in parts[1:]:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=part)
+    usage_stats.record_translation(user_id, len(segments) - failed)
+    if failed < len(segments):
+        await save_translation_history(user_id, user_text, history_text)
+
+
+def quota_footer(daily_limit, remaining_days):
+    return f"\n\n今日剩余翻译次数：{daily_limit}\n剩余天数：{remaining_days}"
+
+
+async def stream_translation(update, context, user_text, answered_by=None):
+    # 先发送占位消息，随着各段落生成完成逐步编辑，编辑频率受 STREAM_EDIT_INTERVAL 限制
+    sent_message = await context.bot.send_message(chat_id=update.effective_chat.id, text="⏳ 正在翻译…", reply_to_message_id=update.message.message_id)
+    translation = ''
+    shown = None
+    last_edit = time.monotonic()
+    pool = await get_gemini_pool_async()
+    try:
+        async for chunk in pool.stream_async(build_translation_prompt(user_text), task='translate', answered_by=answered_by, generation_config=TRANSLATION_GENERATION_CONFIG):
+            translation += chunk
+            if time.monotonic() - last_edit < STREAM_EDIT_INTERVAL:
+                continue
+            partial = format_partial_translation(translation)
+            if partial and partial != shown:
+                try:
+                    await sent_message.edit_text(partial)
+                    shown = partial
+                except telegram.error.TelegramError as e:
+                    logging.warning(f"流式编辑翻译消息失败: {e}")
+                last_edit = time.monotonic()
+    except BaseException:
+        # 流中断时删除占位消息（含已显示的部分译文），错误提示由调用方单独发送，额度由调用方退还
+        try:
+            await sent_message.delete()
+        except telegram.error.TelegramError as e:
+            logging.warning(f"删除流式翻译占位消息失败: {e}")
+        raise
+    body, history_text = format_translation(translation)
+    return sent_message, body, history_text
+
+
+async def obtain_translation(update, context, user_text):
+    # 依次尝试：缓存 -> 等待正在进行的相同翻译 -> 调用 Gemini
+    # 返回 (已发送的流式消息或 None, 回复正文, 历史译文)
+    # 缓存按首选模型查找，只缓存首选模型给出的译文；故障切换到其他模型（如不支持 JSON 模式的 Gemma）的结果不缓存
+    cache_key = translation_cache.make_key(user_text, GEMINI_MODELS[0])
+    cached = await run_local_db(translation_cache.get, cache_key)
+    if cached:
+        return None, cached[0], cached[1]
+
+    future = inflight_translations.get(cache_key)
+    if future:
+        # 相同文本正在翻译中，共用同一次 Gemini 调用的结果
+        singleflight_stats['followers'] += 1
+        body, history_text = await asyncio.shield(future)
+        return None, body, history_text
+
+    future = asyncio.get_running_loop().create_future()
+    inflight_translations[cache_key] = future
+    singleflight_stats['leaders'] += 1
+    try:
+        pool = await get_gemini_pool_async()
+        answered_by = {}
+        if TRANSLATION_STREAMING:
+            sent_message, body, history_text = await stream_translation(update, context, user_text, answered_by)
+        else:
+            response = await pool.generate_async(build_translation_prompt(user_text), task='translate', answered_by=answered_by, generation_config=TRANSLATION_GENERATION_CONFIG)
+            body, history_text = format_translation(response.text)
+            sent_message = None
+        pool.translations += 1
+        if history_text and answered_by.get('model_name') == GEMINI_MODELS[0]:
+            run_local_db(translation_cache.put, cache_key, body, history_text)
+        future.set_result((body, history_text))
+        return sent_message, body, history_text
+    except BaseException as e:
+        error = e if isinstance(e, Exception) else GeminiUnavailable("翻译请求已取消。")
+        future.set_exception(error)
+        future.exception()  # 没有等待者时避免 "exception was never retrieved" 警告
+        raise
+    finally:
+        inflight_translations.pop(cache_key, None)
+
+
+def singleflight_summary():
+    return f"合并翻译请求：发起 {singleflight_stats['leaders']} 次，合并 {singleflight_stats['followers']} 次（节省的 Gemini 调用）"
+
+
 async def translate(update, context):
     try:
         user = update.effective_user
         user_id = user.id
         username = user.username if user.username else 'default_user'
-        user_info = get_user_info(user_id, username)
+        user_info = await get_user_info(user_id, username)
 
         if user_id not in user_translation_status or user_translation_status[user_id] == 'enabled':
             user_text = update.message.text
-            if len(user_text) > 20:
-                await context.bot.send_message(chat_id=update.effective_chat.id, text="免费用户每次翻译内容不能超过20字，文字较多可以断句分次发送。")
+            if len(user_text) > FREE_TEXT_MAX_CHARS:
+                if not is_vip_user(user_id, user_info):
+                    await context.bot.send_message(chat_id=update.effective_chat.id, text="免费用户每次翻译内容不能超过20字，文字较多可以断句分次发送。")
+                elif len(user_text) > LONG_TEXT_MAX_CHARS:
+                    await context.bot.send_message(chat_id=update.effective_chat.id, text=f"每次翻译内容不能超过{LONG_TEXT_MAX_CHARS}字，请分次发送。")
+                else:
+                    await translate_long_text(update, context, user_id, user_info, user_text)
                 return
 
-            if user_info['daily_limit'] > 0 and user_info['remaining_days'] > 0:
-                prompt = f"将以下中文文本翻译成老挝语，并用拉丁语展示老挝语的发音，返回中文注释、老挝语发音和纯汉字谐音。中文文本：{user_text}。格式：\n\n完整翻译：\n发音：（内容用拉丁语）\n纯汉字谐音：\n中文词语分析：（中文词语：老挝词语 （纯汉字谐音））"
-                genai.configure(api_key=get_current_api_config()['api_key'])
-                model = genai.GenerativeModel(get_current_model())
-                response = model.generate_content(prompt)
-                translation = response.text
-                translation = re.sub(r'纯汉字谐音：(.*?)\n', lambda x: f'纯汉字谐音：{re.sub(r"[^\u4e00-\u9fa5]", "", x.group(1))}\n', translation)
-
-                full_translation = re.search(r'完整翻译：(.*?)发音：', translation, re.DOTALL)
-                latin_pronunciation = re.search(r'发音：(.*?)纯汉字谐音：', translation, re.DOTALL)
-                chinese_homophonic = re.search(r'纯汉字谐音：(.*?)中文词语分析：', translation, re.DOTALL)
-                word_analysis = re.search(r'中文词语分析：(.*)', translation, re.DOTALL)
-
-                formatted_translation = f"----------------------------\n🇱🇦正文：\n{clean_text(full_translation.group(1).strip().replace('。', '\n')) if full_translation else '翻译结果未找到'}\n\n️发音：\n{clean_text(latin_pronunciation.group(1).strip().replace('。', '\n')) if latin_pronunciation else '拉丁发音结果未找到'}\n\n🇨🇳谐音：\n{clean_text(chinese_homophonic.group(1).strip()) if chinese_homophonic else '谐音结果未找到'}\n\n中文词语分析：\n{clean_text(word_analysis.group(1).strip()) if word_analysis else '词语分析结果未找到'}\n\n今日剩余翻译次数：{user_info['daily_limit'] - 1}\n剩余天数：{user_info['remaining_days'] - 1}"
+            # 调用模型前先原子地预留一次额度，同一用户的并发消息不会重复使用同一次额度
+            status, daily_limit, remaining_days = quota_ledger.reserve(user_id, user_info)
+            if status == 'ok':
+                try:
+                    sent_message, body, history_text = await obtain_translation(update, context, user_text)
+                except Exception:
+                    quota_ledger.refund(user_id)
+                    raise
+                if history_text:
+                    quota_ledger.commit(user_id)
+                else:
+                    # 没有解析出译文，不扣除次数
+                    quota_ledger.refund(user_id)
+                    daily_limit += 1
 
-                await context.bot.send_message(chat_id=update.effective_chat.id, text=formatted_translation, reply_to_message_id=update.message.message_id)
+                formatted_translation = body + quota_footer(daily_limit, remaining_days)
+                if sent_message:
+                    await sent_message.edit_text(formatted_translation)
+                else:
+                    await context.bot.send_message(chat_id=update.effective_chat.id, text=formatted_translation, reply_to_message_id=update.message.message_id)
 
-                update_user_daily_limit(user_id, user_info['daily_limit'] - 1)
-                update_user_remaining_days(user_id, user_info['remaining_days'] - 1)
-                await save_translation_history(user_id, user_text, clean_text(full_translation.group(1).strip().replace('。', '\n')) if full_translation else '翻译失败')
-            elif user_info['remaining_days'] <= 0:
+                usage_stats.record_translation(user_id)
+                await save_translation_history(user_id, user_text, history_text or '翻译失败')
+            elif status == 'no_days':
                 await context.bot.send_message(chat_id=update.effective_chat.id, text="您的试用天数已用完，升级为vip用户体验更完美")
             else:
                 await context.bot.send_message(chat_id=update.effective_chat.id, text="今日翻译次数已用完，明日可以继续使用，升级为vip用户体验更完美")
@@ -449,7 +2310,7 @@ async def translate(update, context):
 async def start(update, context):
     user = update.effective_user
     username = user.username if user.username else 'default_user'
-    get_user_info(user.id, username) # 确保新用户在 /start 时被录入
+    await get_user_info(user.id, username) # 确保新用户在 /start 时被录入
 
     if user.id in ADMIN_IDS:
         # 管理员键盘 (美化后)
@@ -465,166 +2326,256 @@ async def start(update, context):
         )
     else:
         # 普通用户键盘 (美化后 - 初始状态为“开启翻译”)
-        keyboard = [
-            # ['💰 账号出售', '🌐 网站搭建', '🚀 AI创业'],
-            # ['💸 网赚资源', '🛠️ 常用工具', '👨‍🏫 技术指导'],
-            ['🚫 关闭翻译' if user.id in user_translation_status and user_translation_status[user.id] == 'enabled' else '🔄 开启翻译', '👤 我的资料']
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        reply_markup = translation_keyboard(user_translation_status.get(user.id) == 'enabled')
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text=f"你好，{user.first_name}！欢迎使用我们的多功能机器人。\n\n你可以通过以下按钮体验不同的功能：",
             reply_markup=reply_markup
         )
 
-async def admin_button_click(update: Update, context: CallbackContext):
-    user = update.effective_user
-    button_text = update.message.text
-    print(f"Admin {user.id} clicked button: {button_text}")
-    print(f"Chat ID: {update.effective_chat.id}")
-    print(f"context.application.user_data for chat {update.effective_chat.id}: {context.application.user_data.get(update.effective_chat.id)}")
-    if button_text == '查看统计':
-        await admin_stats(update, context)
-    elif button_text == '设置次数':
-        context.user_data.setdefault(update.effective_chat.id, {})['expecting_admin_set_limit'] = True
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="请发送要设置次数的用户ID和新的次数，格式为：`用户ID 新的次数`", parse_mode=telegram.constants.ParseMode.MARKDOWN)
-        print(f"Admin {user.id}: expecting_admin_set_limit set to True in admin_button_click")
-    elif button_text == '设置天数':
-        context.user_data.setdefault(update.effective_chat.id, {})['expecting_admin_set_days'] = True
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="请发送要设置天数的用户ID和新的天数，格式为：`用户ID 新的天数`", parse_mode=telegram.constants.ParseMode.MARKDOWN)
-        print(f"Admin {user.id}: expecting_admin_set_days set to True in admin_button_click")
-    elif button_text == '发送广播':
-        context.user_data.setdefault(update.effective_chat.id, {})['expecting_admin_broadcast'] = True
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="请发送要广播的消息内容：")
-        print(f"Admin {user.id}: expecting_admin_broadcast set to True in admin_button_click")
+def translation_keyboard(enabled):
+    keyboard = [
+        # ['💰 账号出售', '🌐 网站搭建', '🚀 AI创业'],
+        # ['💸 网赚资源', '🛠️ 常用工具', '👨‍🏫 技术指导'],
+        ['🚫 关闭翻译' if enabled else '🔄 开启翻译', '👤 我的资料']
+    ]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+
+async def set_translation(update, context, enabled):
+    user_translation_status[update.effective_user.id] = 'enabled' if enabled else 'disabled'
+    text = "翻译功能已开启。" if enabled else "翻译功能已关闭。"
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text, reply_markup=translation_keyboard(enabled))
+
+
+async def enable_translation(update, context):
+    await set_translation(update, context, True)
+
+
+async def disable_translation(update, context):
+    await set_translation(update, context, False)
+
+
+async def toggle_translation(update, context):
+    await set_translation(update, context, user_translation_status.get(update.effective_user.id) != 'enabled')
+
+
+async def show_submenu(update, context):
+    keyboard = [['1', '2', '3'], ['4', '5', '6'], ['🔙 返回主键盘']]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=f"请选择 {SUBMENU_LABELS[update.message.text]} 的子功能：", reply_markup=reply_markup)
+
+
+async def show_submenu_choice(update, context):
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=f"您选择了 {update.message.text}。")
+
+
+async def translate_or_hint(update, context):
+    if user_translation_status.get(update.effective_user.id) == 'enabled':
+        await translate(update, context)
     else:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="无效的管理操作。")
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="无效输入，请从主菜单开启翻译")
 
-async def handle_admin_input(update: Update, context: CallbackContext):
-    user = update.effective_user
-    print(f"handle_admin_input called for user {user.id} with text: {update.message.text}")
-    print(f"context.user_data in handle_admin_input: {context.user_data.get(update.effective_chat.id)}")
-    if context.user_data.get(update.effective_chat.id, {}).get('expecting_admin_set_limit'):
-        text = update.message.text
-        parts = text.split()
-        if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
-            target_user_id = int(parts[0])
-            new_limit = int(parts[1])
-            await admin_set_limit(update, context, target_user_id, new_limit) # 调用修改后的 admin_set_limit
-        else:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="格式错误。请发送：`用户ID 新的次数`", parse_mode=telegram.constants.ParseMode.MARKDOWN)
-        context.user_data.get(update.effective_chat.id, {}).pop('expecting_admin_set_limit', None)
-    elif context.user_data.get(update.effective_chat.id, {}).get('expecting_admin_set_days'):
-        text = update.message.text
-        parts = text.split()
-        if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
-            target_user_id = int(parts[0])
-            new_days = int(parts[1])
-            await admin_set_days(update, context, target_user_id, new_days)
-        else:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="格式错误。请发送：`用户ID 新的天数`", parse_mode=telegram.constants.ParseMode.MARKDOWN)
-        context.user_data.get(update.effective_chat.id, {}).pop('expecting_admin_set_days', None)
-    elif context.user_data.get(update.effective_chat.id, {}).get('expecting_admin_broadcast'):
-        message = update.message.text
-        await admin_broadcast(update, context,
-[message])
-        context.user_data.get(update.effective_chat.id, {}).pop('expecting_admin_broadcast', None)
-
-async def button_click(update, context):
-    user = update.effective_user
-    button_text = update.message.text
-    if user.id in ADMIN_IDS:
-        if button_text == '📊 查看统计':
-            await admin_stats(update, context)
-        elif button_text == '🔢 设置次数':
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="请发送要设置次数的用户ID和新的次数，格式为：`用户ID 新的次数`", parse_mode=telegram.constants.ParseMode.MARKDOWN)
-            context.user_data['expecting_admin_set_limit'] = True
-        elif button_text == '🗓️ 设置天数':
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="请发送要设置天数的用户ID和新的天数，格式为：`用户ID 新的天数`", parse_mode=telegram.constants.ParseMode.MARKDOWN)
-            context.user_data['expecting_admin_set_days'] = True
-        elif button_text == '📢 发送广播':
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="请发送要广播的消息内容：")
-            context.user_data['expecting_admin_broadcast'] = True
-        else:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="无效的管理操作。")
+
+async def prompt_admin_set_limit(update, context):
+    context.chat_data['state'] = 'admin_set_limit'
+    await context.bot.send_message(chat_id=update.effective_chat.id, text="请发送要设置次数的用户ID和新的次数，格式为：`用户ID 新的次数`", parse_mode=telegram.constants.ParseMode.MARKDOWN)
+
+
+async def prompt_admin_set_days(update, context):
+    context.chat_data['state'] = 'admin_set_days'
+    await context.bot.send_message(chat_id=update.effective_chat.id, text="请发送要设置天数的用户ID和新的天数，格式为：`用户ID 新的天数`", parse_mode=telegram.constants.ParseMode.MARKDOWN)
+
+
+async def prompt_admin_broadcast(update, context):
+    context.chat_data['state'] = 'admin_broadcast'
+    await context.bot.send_message(chat_id=update.effective_chat.id, text="请发送要广播的消息内容：")
+
+
+def parse_admin_pair(text):
+    parts = text.split()
+    if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
+        return int(parts[0]), int(parts[1])
+    return None
+
+
+async def handle_admin_set_limit(update, context):
+    pair = parse_admin_pair(update.message.text)
+    if pair:
+        await admin_set_limit(update, context, *pair)
     else:
-        # 普通用户的按钮点击逻辑
-        if button_text == '🔄 翻译开关':
-            if user.id not in user_translation_status or user_translation_status[user.id] == 'disabled':
-                user_translation_status[user.id] = 'enabled'
-                # 更新按钮文本为“关闭翻译”
-                keyboard = [
-                    # ['💰 账号出售', '🌐 网站搭建', '🚀 AI创业'],
-                    # ['💸 网赚资源', '🛠️ 常用工具', '👨‍🏫 技术指导'],
-                    ['🚫 关闭翻译', '👤 我的资料']
-                ]
-                reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                await context.bot.send_message(chat_id=update.effective_chat.id, text="翻译功能已开启。", reply_markup=reply_markup)
-            else:
-                user_translation_status[user.id] = 'disabled'
-                # 更新按钮文本为“开启翻译”
-                keyboard = [
-                    # ['💰 账号出售', '🌐 网站搭建', '🚀 AI创业'],
-                   # ['💸 网赚资源', '🛠️ 常用工具', '👨‍🏫 技术指导'],
-                    ['🔄 开启翻译', '👤 我的资料']
-                ]
-                reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                await context.bot.send_message(chat_id=update.effective_chat.id, text="翻译功能已关闭。", reply_markup=reply_markup)
-        elif button_text in ['💰 账号出售', '🌐 网站搭建', '🚀 AI创业', '💸 网赚资源', '🛠️ 常用工具', '👨‍🏫 技术指导']:
-            keyboard = [['1', '2', '3'], ['4', '5', '6'], ['🔙 返回主键盘']]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=f"请选择 {button_text.replace('💰 ', '').replace('🌐 ', '').replace('🚀 ', '').replace('💸 ', '').replace('🛠️ ', '').replace('👨‍🏫 ', '')} 的子功能：", reply_markup=reply_markup)
-        elif button_text in ['1', '2', '3', '4', '5', '6']:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=f"您选择了 {button_text}。")
-        elif button_text == '🔙 返回主键盘':
-            await start(update, context)
-        elif button_text == '👤 我的资料':
-            await profile(update, context)
-        elif button_text in ['🔄 开启翻译', '🚫 关闭翻译']: # 处理动态变化的翻译按钮点击
-            if button_text == '🔄 开启翻译':
-                user_translation_status[user.id] = 'enabled'
-                keyboard = [
-                  #  ['💰 账号出售', '🌐 网站搭建', '🚀 AI创业'],
-                   # ['💸 网赚资源', '🛠️ 常用工具', '👨‍🏫 技术指导'],
-                    ['🚫 关闭翻译', '👤 我的资料']
-                ]
-                reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                await context.bot.send_message(chat_id=update.effective_chat.id, text="翻译功能已开启。", reply_markup=reply_markup)
-            elif button_text == '🚫 关闭翻译':
-                user_translation_status[user.id] = 'disabled'
-                keyboard = [
-                   # ['💰 账号出售', '🌐 网站搭建', '🚀 AI创业'],
-                   # ['💸 网赚资源', '🛠️ 常用工具', '👨‍🏫 技术指导'],
-                    ['🔄 开启翻译', '👤 我的资料']
-                ]
-                reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                await context.bot.send_message(chat_id=update.effective_chat.id, text="翻译功能已关闭。", reply_markup=reply_markup)
-        else:
-            if user.id in user_translation_status and user_translation_status[user.id] == 'enabled':
-                await translate(update,context)
-            else:
-                await context.bot.send_message(chat_id=update.effective_chat.id, text="无效输入，请从主菜单开启翻译")
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="格式错误。请发送：`用户ID 新的次数`", parse_mode=telegram.constants.ParseMode.MARKDOWN)
+
+
+async def handle_admin_set_days(update, context):
+    pair = parse_admin_pair(update.message.text)
+    if pair:
+        await admin_set_days(update, context, *pair)
+    else:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="格式错误。请发送：`用户ID 新的天数`", parse_mode=telegram.constants.ParseMode.MARKDOWN)
+
+
+async def handle_admin_broadcast(update, context):
+    await admin_broadcast(update, context, [update.message.text])
+
+
+async def invalid_admin_action(update, context):
+    await context.bot.send_message(chat_id=update.effective_chat.id, text="无效的管理操作。")
+
+
+SUBMENU_LABELS = {'💰 账号出售': '账号出售', '🌐 网站搭建': '网站搭建', '🚀 AI创业': 'AI创业', '💸 网赚资源': '网赚资源', '🛠️ 常用工具': '常用工具', '👨‍🏫 技术指导': '技术指导'}
+
+# 按钮文字 -> 处理函数；管理员键盘同时接受带表情和不带表情的文字
+ADMIN_ACTIONS = {
+    '📊 查看统计': admin_stats, '查看统计': admin_stats,
+    '🔢 设置次数': prompt_admin_set_limit, '设置次数': prompt_admin_set_limit,
+    '🗓️ 设置天数': prompt_admin_set_days, '设置天数': prompt_admin_set_days,
+    '📢 发送广播': prompt_admin_broadcast, '发送广播': prompt_admin_broadcast,
+}
+USER_ACTIONS = {
+    '🔄 翻译开关': toggle_translation,
+    '🔄 开启翻译': enable_translation,
+    '🚫 关闭翻译': disable_translation,
+    '👤 我的资料': profile,
+    '🔙 返回主键盘': start,
+    **{label: show_submenu for label in SUBMENU_LABELS},
+    **{str(choice): show_submenu_choice for choice in range(1, 7)},
+}
+# 会话状态 -> 处理下一条文字消息的函数（每个状态只处理一条消息）
+STATE_ACTIONS = {
+    'feedback': handle_feedback_message,
+    'admin_set_limit': handle_admin_set_limit,
+    'admin_set_days': handle_admin_set_days,
+    'admin_broadcast': handle_admin_broadcast,
+}
+
+
+def resolve_route(is_admin, state, text):
+    # 按钮优先（点击按钮会取消正在等待的输入），其次是会话状态，最后是默认处理
+    action = (ADMIN_ACTIONS if is_admin else USER_ACTIONS).get(text)
+    if action is None:
+        action = STATE_ACTIONS.get(state) or (invalid_admin_action if is_admin else translate_or_hint)
+    return action
+
+
+async def route_message(update: Update, context: CallbackContext):
+    state = context.chat_data.pop('state', None)
+    action = resolve_route(update.effective_user.id in ADMIN_IDS, state, update.message.text)
+    await action(update, context)
+
+
+VOCABULARY_LINE = re.compile(r'^\s*[*-]?\s*(.+?)\s*[:：]\s*(.+?)\s*[（(](.+?)[)）]', re.MULTILINE)
+
+
+def init_vocabulary_tables(db):
+    with local_db_lock:
+        db.execute('CREATE TABLE IF NOT EXISTS vocab_queue (id INTEGER PRIMARY KEY AUTOINCREMENT, category TEXT NOT NULL, text TEXT NOT NULL, created_at REAL NOT NULL)')
+        db.execute('CREATE TABLE IF NOT EXISTS vocab_seen (key TEXT PRIMARY KEY, added_at REAL NOT NULL)')
+        db.commit()
+
+
+def get_vocab_seen():
+    global vocab_seen
+    if vocab_seen is None:
+        db = get_local_db()
+        init_vocabulary_tables(db)
+        with local_db_lock:
+            vocab_seen = OrderedDict((row[0], None) for row in db.execute('SELECT key FROM vocab_seen ORDER BY added_at'))
+    return vocab_seen
+
+
+def remember_vocabulary(keys):
+    # 有界的去重集合：超过 VOCAB_SEEN_MAX 时淘汰最早的条目
+    seen = get_vocab_seen()
+    now = time.time()
+    for key in keys:
+        seen[key] = None
+        seen.move_to_end(key)
+    evicted = []
+    while len(seen) > VOCAB_SEEN_MAX:
+        evicted.append(seen.popitem(last=False)[0])
+    db = get_local_db()
+    with local_db_lock:
+        db.executemany('INSERT OR REPLACE INTO vocab_seen VALUES (?, ?)', [(key, now) for key in keys])
+        db.executemany('DELETE FROM vocab_seen WHERE key = ?', [(key,) for key in evicted])
+        db.commit()
+
+
+def queued_vocabulary_counts():
+    db = get_local_db()
+    init_vocabulary_tables(db)
+    with local_db_lock:
+        return dict(db.execute('SELECT category, COUNT(*) FROM vocab_queue GROUP BY category').fetchall())
+
+
+async def generate_vocabulary(category):
+    # 生成一条词汇并校验格式、去重；不合格时返回 None
+    recent = list(get_vocab_seen())[-20:]
+    prompt = f"分类：{category}。已用词汇/句子：{recent}"
+    pool = await get_gemini_pool_async()
+    response = await pool.generate_async(prompt, hedge=False, task='vocabulary')
+    vocabulary = clean_text(response.text)
+    items = VOCABULARY_LINE.findall(vocabulary)
+    if not items:
+        logging.warning(f"生成的词汇格式不正确，已丢弃: {vocabulary}")
+        return None
+    keys = [normalize_text(item[1]) for item in items]
+    if any(key in get_vocab_seen() for key in keys):
+        logging.info(f"生成的词汇重复，已丢弃: {vocabulary}")
+        return None
+    remember_vocabulary(keys)
+    return vocabulary
+
+
+async def fill_vocabulary_pool(context: CallbackContext):
+    # 后台预先生成词汇，0 点发送时不需要调用模型
+    counts = queued_vocabulary_counts()
+    missing = VOCAB_POOL_TARGET - sum(counts.values())
+    attempts = missing * 3
+    while missing > 0 and attempts > 0:
+        attempts -= 1
+        # 优先补充排队数量最少的分类，使各分类分布均匀
+        fewest = min(counts.get(category, 0) for category in VOCAB_CATEGORIES)
+        category = random.choice([category for category in VOCAB_CATEGORIES if counts.get(category, 0) == fewest])
+        try:
+            vocabulary = await generate_vocabulary(category)
+        except Exception as e:
+            logging.error(f"预生成词汇时出错: {e}")
+            return
+        if not vocabulary:
+            continue
+        db = get_local_db()
+        with local_db_lock:
+            db.execute('INSERT INTO vocab_queue (category, text, created_at) VALUES (?, ?, ?)', (category, vocabulary, time.time()))
+            db.commit()
+        counts[category] = counts.get(category, 0) + 1
+        missing -= 1
+
+
+def pop_vocabulary():
+    db = get_local_db()
+    init_vocabulary_tables(db)
+    with local_db_lock:
+        row = db.execute('SELECT id, text FROM vocab_queue ORDER BY id LIMIT 1').fetchone()
+        if row:
+            db.execute('DELETE FROM vocab_queue WHERE id = ?', (row[0],))
+            db.commit()
+    return row[1] if row else None
+
 
 async def send_lao_vocabulary(context: CallbackContext):
     try:
-        categories = ['交通', '教育', '日常', '工具', '餐饮', '娱乐', '房产', '汽车', '家用', '旅游', '航天', '婚姻', '情感', '社会', '名词', '动词', '代词', '副词', '形容词', '介词', '连接词', '感叹词', '限定词', '时间', '地点', '称呼', '动物', '植物', '行为', '运动', '单位', '数字', '关系', '身体', '颜色', '人体器官']
-        selected_categories = random.sample(categories,5)
-
-        prompt = f"从以下分类中随机生成 1 个老挝语词汇或句子，并提供中文翻译和拉丁语发音。分类：{', '.join(selected_categories)}。格式：中文：老挝语（谐音用汉语拼音）。已发送的词汇/句子：{sent_vocabulary}"
-        genai.configure(api_key=get_current_api_config()['api_key'])
-        model = genai.GenerativeModel(get_current_model())
-        response = model.generate_content(prompt)
-        vocabulary = response.text
-        new_vocabulary = re.findall(r'^(.*?): (.*?)\((.*?)\)', vocabulary, re.MULTILINE)
-        if new_vocabulary:
-            sent_vocabulary.extend([item[1] for item in new_vocabulary])
-
-        user_ids = get_all_user_ids()
-        for user_id in user_ids:
-            try:
-                await context.bot.send_message(chat_id=user_id, text=vocabulary)
-            except Exception as e:
-                print(f"发送词汇给用户 {user_id} 时出错：{e}")
+        vocabulary = pop_vocabulary()
+        if not vocabulary:
+            # 队列为空时才临时生成
+            logging.warning("词汇队列为空，临时生成词汇。")
+            vocabulary = await generate_vocabulary(random.choice(VOCAB_CATEGORIES))
+        if not vocabulary:
+            print("send_lao_vocabulary 没有可发送的词汇。")
+            return
+
+        user_ids = await run_sheets(get_all_user_ids)
+        await run_broadcast(context.bot, create_broadcast(vocabulary, user_ids))
 
         try:
             await context.bot.send_message(chat_id=GROUP_ID, text=vocabulary)
@@ -634,92 +2585,168 @@ async def send_lao_vocabulary(context: CallbackContext):
     except Exception as e:
         print(f"send_lao_vocabulary 函数出错：{e}")
 
-def reset_user_daily_limit_status():
-    global user_daily_limit_status
-    user_daily_limit_status = {}
+async def health_check(request):
+    return web.json_response({'status': 'ok'})
 
-def reset_user_remaining_days_status(user_id=None):
-    global user_remaining_days_status
-    if user_id:
-        if user_id in user_remaining_days_status:
-            del user_remaining_days_status[user_id]
-    else:
-        user_remaining_days_status = {}
-
-class ExpectingAdminInput(MessageFilter):
-    def filter(self, message: telegram.Message) -> bool:
-        user_id = message.from_user.id
-        context = CallbackContext.from_update(message, message._bot)
-        return user_id in ADMIN_IDS and (
-            message.chat.id in context.user_data and (
-                context.user_data[message.chat.id].get('expecting_admin_set_limit') is True or
-                context.user_data[message.chat.id].get('expecting_admin_broadcast') is True or
-                context.user_data[message.chat.id].get('expecting_admin_set_days') is True
-            )
-        )
 
-expecting_admin_input_filter = ExpectingAdminInput()
+async def readiness_check(request):
+    application = request.app['application']
+    ready = application.running and user_table_loaded
+    return web.json_response({'ready': ready, 'mode': 'webhook' if WEBHOOK_URL else 'polling', 'users': len(user_table)}, status=200 if ready else 503)
 
-def main():
-    try:
-        application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
-
-        start_handler = CommandHandler('start', start)
-        application.add_handler(start_handler)
-
-        async def admin_button_handler_callback(update: Update, context: CallbackContext):
-            if update.message.text == '查看统计':
-                await admin_button_click(update, context)
-            elif update.message.text == '设置次数':
-                context.user_data.setdefault(update.effective_chat.id, {})['expecting_admin_set_limit'] = True
-                await context.bot.send_message(chat_id=update.effective_chat.id, text="请发送要设置次数的用户ID和新的次数，格式为：`用户ID 新的次数`", parse_mode=telegram.constants.ParseMode.MARKDOWN)
-                print(f"Admin {update.effective_user.id}: expecting_admin_set_limit set to True in admin_button_click")
-            elif update.message.text == '设置天数':
-                context.user_data.setdefault(update.effective_chat.id, {})['expecting_admin_set_days'] = True
-                await context.bot.send_message(chat_id=update.effective_chat.id, text="请发送要设置天数的用户ID和新的天数，格式为：`用户ID 新的天数`", parse_mode=telegram.constants.ParseMode.MARKDOWN)
-                print(f"Admin {update.effective_user.id}: expecting_admin_set_days set to True in admin_button_click")
-            elif update.message.text == '发送广播':
-                context.user_data.setdefault(update.effective_chat.id, {})['expecting_admin_broadcast'] = True
-                await context.bot.send_message(chat_id=update.effective_chat.id, text="请发送要广播的消息内容：")
-                print(f"Admin {update.effective_user.id}: expecting_admin_broadcast set to True in admin_button_click")
-            elif context.user_data.get(update.effective_chat.id, {}).get('expecting_admin_set_limit') and update.message.text != '设置次数':
-                await handle_admin_input(update, context)
-            elif context.user_data.get(update.effective_chat.id, {}).get('expecting_admin_set_days') and update.message.text != '设置天数':
-                await handle_admin_input(update, context)
-            elif context.user_data.get(update.effective_chat.id, {}).get('expecting_admin_broadcast') and update.message.text != '发送广播':
-                await handle_admin_input(update, context)
-            return None
 
-        admin_button_handler = MessageHandler(Filters.TEXT & Filters.User(ADMIN_IDS), admin_button_handler_callback)
-        application.add_handler(admin_button_handler)
+async def env_check(request):
+    # 原 flasksheets.py 提供的路由
+    return web.Response(text=f"SHEET_RANGE: {SHEET_RANGE}")
 
-        admin_input_handler = MessageHandler(Filters.TEXT & (~Filters.COMMAND) & Filters.User(ADMIN_IDS) & expecting_admin_input_filter, handle_admin_input)
-        application.add_handler(admin_input_handler)
 
-        button_handler = MessageHandler(Filters.TEXT & (~Filters.COMMAND) & (~Filters.User(ADMIN_IDS)), button_click)
-        application.add_handler(button_handler)
+async def metrics_endpoint(request):
+    return web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
 
-        translate_handler = MessageHandler(Filters.TEXT & (~Filters.COMMAND) & (~Filters.User(ADMIN_IDS)), translate)
-        application.add_handler(translate_handler)
 
-        history_handler = CommandHandler('history', history)
-        application.add_handler(history_handler)
-
-        profile_handler = CommandHandler('profile', profile)
-        application.add_handler(profile_handler)
-
-        feedback_handler = CommandHandler('feedback', feedback)
-        application.add_handler(feedback_handler)
-
-        feedback_message_handler = MessageHandler(Filters.TEXT & (~Filters.COMMAND), handle_feedback_message)
-        application.add_handler(feedback_message_handler)
+async def telegram_webhook(request):
+    if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    application = request.app['application']
+    try:
+        update = Update.de_json(await request.json(), application.bot)
+    except ValueError:
+        return web.Response(status=400)
+    await application.update_queue.put(update)
+    return web.Response()
+
+
+def build_web_app(application):
+    web_app = web.Application()
+    web_app['application'] = application
+    web_app.router.add_get('/healthz', health_check)
+    web_app.router.add_get('/readyz', readiness_check)
+    web_app.router.add_get('/env', env_check)
+    web_app.router.add_get('/metrics', metrics_endpoint)
+    if WEBHOOK_URL:
+        web_app.router.add_post(f'/telegram/{WEBHOOK_SECRET}', telegram_webhook)
+    return web_app
+
+
+async def timed_warm_up(phase, func, *args, executor=None):
+    start = time.perf_counter()
+    try:
+        if executor is sheets_executor:
+            await run_sheets(func, *args)
+        else:
+            await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    except Exception as e:
+        logging.warning(f"预热 {phase} 失败: {e}")
+    elapsed = time.perf_counter() - start
+    if FAST_START:
+        startup_timer.record_background(phase, elapsed)
+    else:
+        startup_timer.mark(phase)
+
+
+async def warm_up_clients():
+    # 导入 Gemini SDK 并创建客户端池；在 Sheets 线程中构建服务并加载用户表
+    await asyncio.gather(
+        timed_warm_up('Gemini 客户端', get_gemini_pool, executor=gemini_executor),
+        timed_warm_up('Sheets 客户端和用户表', ensure_user_table, executor=sheets_executor),
+    )
+    if FAST_START:
+        logging.info("后台预热完成：" + "，".join(f"{phase} {seconds:.3f} 秒" for phase, seconds in startup_timer.background))
+
+
+async def serve(application):
+    # 同一进程内运行机器人和 HTTP 服务（健康检查，以及 webhook 模式下接收 Telegram 更新）
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise RuntimeError("webhook 模式需要设置 WEBHOOK_SECRET。")
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    runner = web.AppRunner(build_web_app(application))
+    await runner.setup()
+    run_in_background(monitor_event_loop())
+    async with application:
+        startup_timer.mark('连接 Telegram')
+        if application.post_init:
+            await application.post_init(application)
+        if not FAST_START:
+            await warm_up_clients()
+        await application.start()
+        await web.TCPSite(runner, '0.0.0.0', PORT).start()
+        logging.info(f"HTTP 服务监听端口 {PORT}")
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(url=f"{WEBHOOK_URL.rstrip('/')}/telegram/{WEBHOOK_SECRET}", secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+            logging.info("webhook 模式已启动。")
+        else:
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            logging.info("长轮询模式已启动。")
+        startup_timer.mark('开始接收更新')
+        if FAST_START:
+            run_in_background(warm_up_clients())
+        await stop_event.wait()
+        await runner.cleanup()
+        if application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+        # 先写回表格，再保存快照；退出 async with 时由持久化写入磁盘
+        await run_sheets(write_behind.flush)
+        snapshot_state(application.bot_data, final=True)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+def build_application(base_url=None):
+    # base_url 用于指向本地的 Bot API 替身（loadtest.py）
+    builder = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).request(MeteredRequest()).get_updates_request(MeteredRequest(connection_pool_size=1)).concurrent_updates(PerUserUpdateProcessor(UPDATE_WORKERS, UPDATE_USER_QUEUE)).persistence(PicklePersistence(filepath=PERSISTENCE_PATH, update_interval=PERSISTENCE_INTERVAL)).post_init(on_startup).post_shutdown(flush_on_shutdown)
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
+
+    start_handler = CommandHandler('start', start)
+    application.add_handler(start_handler)
+
+    # 所有文字消息由 route_message 按按钮文字和会话状态分发
+    application.add_handler(MessageHandler(Filters.TEXT & (~Filters.COMMAND), route_message))
+
+    history_handler = CommandHandler('history', history)
+    application.add_handler(history_handler)
+    application.add_handler(CallbackQueryHandler(history_page_callback, pattern=r'^history:\d+$'))
+    application.add_handler(CallbackQueryHandler(admin_stats_callback, pattern=r'^stats:\d+$'))
+
+    profile_handler = CommandHandler('profile', profile)
+    application.add_handler(profile_handler)
+
+    feedback_handler = CommandHandler('feedback', feedback)
+    application.add_handler(feedback_handler)
+
+    refresh_users_handler = CommandHandler('refresh_users', admin_refresh_users)
+    application.add_handler(refresh_users_handler)
+
+    tokens_handler = CommandHandler('tokens', admin_token_stats)
+    application.add_handler(tokens_handler)
+
+    target_time = datetime.time(hour=0, minute=0, second=0)
+    application.job_queue.run_daily(daily_reset_job, time=datetime.time(hour=0, minute=0, second=0, tzinfo=LAO_TZ))
+    application.job_queue.run_once(catch_up_daily_reset, when=10)
+    application.job_queue.run_repeating(flush_sheet_writes, interval=WRITE_FLUSH_INTERVAL, first=WRITE_FLUSH_INTERVAL)
+    application.job_queue.run_repeating(refresh_user_table, interval=USER_TABLE_REFRESH_SECONDS, first=USER_TABLE_REFRESH_SECONDS)
+    application.job_queue.run_repeating(snapshot_state_job, interval=PERSISTENCE_INTERVAL, first=PERSISTENCE_INTERVAL)
+    application.job_queue.run_repeating(fill_vocabulary_pool, interval=VOCAB_PRODUCER_INTERVAL, first=30)
+    application.job_queue.run_once(backfill_history_job, when=1)
+    application.job_queue.run_once(send_lao_vocabulary, when=5)
+    application.job_queue.run_daily(send_lao_vocabulary, time=target_time)
+    return application
 
-        target_time = datetime.time(hour=0, minute=0, second=0)
-        application.job_queue.run_daily(reset_user_daily_limit_status, time=target_time)
-        application.job_queue.run_once(send_lao_vocabulary, when=5)
-        application.job_queue.run_daily(send_lao_vocabulary, time=target_time)
 
-        application.run_polling()
+def main():
+    try:
+        startup_timer.mark('导入模块')
+        application = build_application()
+        startup_timer.mark('构建应用')
+        asyncio.run(serve(application))
 
     except Exception as e:
         print(f"main 函数出错：{e}")
@@ -0,0 +1,315 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from collections import Counter
+
+# 离线压测：用本地替身代替 Telegram Bot API、Gemini 和 Google Sheets，
+# 把合成的 Update 交给 build_application() 构建的真实处理器，统计端到端延迟和吞吐量
+# 用法：python loadtest.py --users 10,100,1000 --messages 2 --gemini-latency 0.8
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:LOADTEST')
+os.environ.setdefault('GOOGLE_SHEET_ID', 'loadtest')
+os.environ.setdefault('SHEET_RANGE', 'UserStats!A2:F')
+os.environ.setdefault('GEMINI_API_KEY_1', 'loadtest-key-1')
+os.environ.setdefault('GEMINI_API_KEY_2', 'loadtest-key-2')
+os.environ.setdefault('GEMINI_API_KEY_3', 'loadtest-key-3')
+os.environ.setdefault('GEMINI_KEY_RPM', '1000000')  # 替身不限流，测的是机器人本身
+STATE_DIR = tempfile.mkdtemp(prefix='loadtest-')
+os.environ.setdefault('LOCAL_DB_PATH', os.path.join(STATE_DIR, 'bot_state.sqlite3'))
+os.environ.setdefault('PERSISTENCE_PATH', os.path.join(STATE_DIR, 'bot_state.pickle'))
+
+from aiohttp import web  # noqa: E402
+from google.api_core import exceptions as google_exceptions  # noqa: E402
+from telegram import Update  # noqa: E402
+
+import geminitgbot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+COMMON_PHRASES = ['你好', '谢谢', '多少钱', '今天天气很好', '我想去市场', '请问厕所在哪里']
+
+
+class FakeBotApi:
+    # 本地 Bot API：按方法计数，对 sendMessage/editMessageText 返回合法的 Message
+    def __init__(self):
+        self.calls = Counter()
+        self.error_replies = 0
+        self.message_ids = itertools.count(1)
+
+    def message(self, chat_id, text):
+        return {'message_id': next(self.message_ids), 'date': int(time.time()), 'chat': {'id': int(chat_id), 'type': 'private'}, 'text': text}
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        self.calls[method] += 1
+        params = dict(await request.post()) if request.body_exists else {}
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'loadtest_bot'}
+        elif method in ('sendMessage', 'editMessageText'):
+            text = params.get('text', '')
+            if '出现错误' in text or '出错' in text:
+                self.error_replies += 1
+            result = self.message(params.get('chat_id', 0), text)
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/bot"
+
+
+class StubChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class StubGeminiModel:
+    # 按对数正态分布模拟延迟，按比例返回 429 或 503
+    def __init__(self, args, counter):
+        self.args = args
+        self.counter = counter
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        self.counter['gemini'] += 1
+        latency = random.lognormvariate(0, self.args.gemini_jitter) * self.args.gemini_latency
+        roll = random.random()
+        if roll < self.args.gemini_429_rate:
+            time.sleep(latency / 4)
+            raise google_exceptions.ResourceExhausted('stub quota exhausted')
+        if roll < self.args.gemini_429_rate + self.args.gemini_error_rate:
+            time.sleep(latency / 2)
+            raise google_exceptions.ServiceUnavailable('stub unavailable')
+        text = self.response_text(prompt)
+        if not stream:
+            time.sleep(latency)
+            return StubChunk(text)
+        return self.stream(text, latency)
+
+    @staticmethod
+    def stream(text, latency):
+        size = max(1, len(text) // 4)
+        for i in range(0, len(text), size):
+            time.sleep(latency / 4)
+            yield StubChunk(text[i:i + size])
+
+    @staticmethod
+    def response_text(prompt):
+        source = prompt.rsplit('\n', 1)[-1][:20]
+        return json.dumps({
+            'translation': f'ສະບາຍດີ {source}',
+            'pronunciation': 'sa bai di',
+            'homophonic': '沙拜迪',
+            'analysis': f'“{source}”的老挝语常用说法。',
+        }, ensure_ascii=False)
+
+
+class SheetsEmulator:
+    # 内存中的 spreadsheets().values()，支持 get / append / update / batchUpdate
+    def __init__(self, latency, counter):
+        self.latency = latency
+        self.counter = counter
+        self.sheets = {}
+        self.lock = threading.Lock()
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def _call(self, name, func):
+        self.counter['sheets'] += 1
+        self.counter[f'sheets.{name}'] += 1
+        return _Request(self.latency, func)
+
+    def _set(self, range_name, values):
+        sheet, cell = range_name.split('!')
+        match = re.match(r'([A-Z])(\d+)', cell)
+        column, first_row = ord(match.group(1)) - ord('A'), int(match.group(2))
+        rows = self.sheets.setdefault(sheet, [])
+        for i, row_values in enumerate(values):
+            while len(rows) < first_row + i:
+                rows.append([])
+            row = rows[first_row + i - 1]
+            for j, value in enumerate(row_values):
+                while len(row) <= column + j:
+                    row.append('')
+                row[column + j] = value
+
+    def get(self, spreadsheetId, range):
+        sheet = range.split('!')[0]
+        first_row = geminitgbot.parse_row_number(range) or 1
+
+        def run():
+            with self.lock:
+                return {'values': [list(row) for row in self.sheets.get(sheet, [])[first_row - 1:]]}
+        return self._call('get', run)
+
+    def append(self, spreadsheetId, range, valueInputOption, body):
+        sheet = range.split('!')[0]
+
+        def run():
+            with self.lock:
+                rows = self.sheets.setdefault(sheet, [])
+                first = len(rows) + 1
+                rows.extend(list(row) for row in body['values'])
+                return {'updates': {'updatedRange': f"{sheet}!A{first}:F{len(rows)}"}}
+        return self._call('append', run)
+
+    def update(self, spreadsheetId, range, valueInputOption, body):
+        def run():
+            with self.lock:
+                self._set(range, body['values'])
+            return {}
+        return self._call('update', run)
+
+    def batchUpdate(self, spreadsheetId, body):
+        def run():
+            with self.lock:
+                for data in body['data']:
+                    self._set(data['range'], data['values'])
+            return {'totalUpdatedCells': len(body['data'])}
+        return self._call('batchUpdate', run)
+
+
+class _Request:
+    def __init__(self, latency, func):
+        self.latency = latency
+        self.func = func
+
+    def execute(self):
+        time.sleep(self.latency)
+        return self.func()
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def make_update(bot, update_id, user_id, text):
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+            'text': text,
+        },
+    }, bot)
+
+
+def seed_users(sheets, user_ids, daily_limit):
+    first_row = geminitgbot.parse_row_number(geminitgbot.SHEET_RANGE) or 1
+    sheet = geminitgbot.SHEET_RANGE.split('!')[0]
+    rows = sheets.sheets.setdefault(sheet, [])
+    while len(rows) < first_row - 1:
+        rows.append([])
+    join_date = geminitgbot.lao_now().strftime('%Y-%m-%d')
+    rows.extend([str(user_id), f'user{user_id}', str(daily_limit), '30', join_date, str(daily_limit)] for user_id in user_ids)
+    for user_id in user_ids:
+        geminitgbot.user_translation_status[user_id] = 'enabled'
+    geminitgbot.load_user_table()
+
+
+async def run_round(application, bot_api, sheets, counter, args, user_count, round_index):
+    user_ids = [(round_index + 1) * 1_000_000 + i for i in range(user_count)]
+    seed_users(sheets, user_ids, args.messages + 1)
+    bot_api.calls.clear()
+    bot_api.error_replies = 0
+    counter.clear()
+    update_ids = itertools.count(round_index * 10_000_000 + 1)
+    latencies = []
+
+    async def simulated_user(user_id):
+        # 每个用户等上一条回复完成后再发下一条
+        await asyncio.sleep(random.random() * args.ramp)
+        for i in range(args.messages):
+            if random.random() < args.repeat:
+                text = random.choice(COMMON_PHRASES)
+            else:
+                text = f'测试{user_id % 100000}第{i}句'
+            update = make_update(application.bot, next(update_ids), user_id, text)
+            start = time.perf_counter()
+            await application.update_processor.process_update(update, application.process_update(update))
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(simulated_user(user_id) for user_id in user_ids))
+    elapsed = time.perf_counter() - start
+    await geminitgbot.run_sheets(geminitgbot.write_behind.flush)
+
+    latencies.sort()
+    translations = len(latencies)
+    telegram_calls = sum(count for method, count in bot_api.calls.items() if method != 'getMe')
+    return {
+        'users': user_count,
+        'updates': translations,
+        'errors': bot_api.error_replies,
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'rate': translations / elapsed if elapsed else 0.0,
+        'telegram': telegram_calls / translations,
+        'gemini': counter['gemini'] / translations,
+        'sheets': counter['sheets'] / translations,
+    }
+
+
+async def main(args):
+    counter = Counter()
+    sheets = SheetsEmulator(args.sheets_latency, counter)
+    geminitgbot.get_sheets_service = lambda: sheets
+    pool = geminitgbot.get_gemini_pool()
+    for client in pool.clients:
+        client.model = StubGeminiModel(args, counter)
+        client.models = {}
+
+    bot_api = FakeBotApi()
+    base_url = await bot_api.start()
+    application = geminitgbot.build_application(base_url=base_url)
+    print(f"Gemini 替身：中位延迟 {args.gemini_latency}s，429 比例 {args.gemini_429_rate:.0%}，503 比例 {args.gemini_error_rate:.0%}；"
+          f"Sheets 替身延迟 {args.sheets_latency}s；流式翻译 {'开' if geminitgbot.TRANSLATION_STREAMING else '关'}\n")
+    print(f"{'用户数':>6}{'更新数':>8}{'错误':>6}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'更新/秒':>10}{'TG/次':>8}{'Gemini/次':>11}{'Sheets/次':>11}")
+    async with application:
+        for round_index, user_count in enumerate(args.users):
+            row = await run_round(application, bot_api, sheets, counter, args, user_count, round_index)
+            print(f"{row['users']:>6}{row['updates']:>8}{row['errors']:>6}{row['p50']:>10.0f}{row['p95']:>10.0f}{row['p99']:>10.0f}"
+                  f"{row['rate']:>10.1f}{row['telegram']:>8.2f}{row['gemini']:>11.2f}{row['sheets']:>11.2f}")
+    await bot_api.runner.cleanup()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='离线压测翻译流程')
+    parser.add_argument('--users', default='10,100,1000', help='每轮模拟的用户数，逗号分隔')
+    parser.add_argument('--messages', type=int, default=2, help='每位用户依次发送的消息数')
+    parser.add_argument('--repeat', type=float, default=0.2, help='发送常用短语（可命中缓存）的比例')
+    parser.add_argument('--ramp', type=float, default=1.0, help='用户在该时间内（秒）陆续开始发送')
+    parser.add_argument('--gemini-latency', type=float, default=0.8, help='Gemini 替身中位延迟（秒）')
+    parser.add_argument('--gemini-jitter', type=float, default=0.4, help='延迟对数正态分布的 sigma')
+    parser.add_argument('--gemini-429-rate', type=float, default=0.01, help='返回 429 的比例')
+    parser.add_argument('--gemini-error-rate', type=float, default=0.01, help='返回 503 的比例')
+    parser.add_argument('--sheets-latency', type=float, default=0.15, help='Sheets 替身每次调用的延迟（秒）')
+    args = parser.parse_args()
+    args.users = [int(value) for value in args.users.split(',') if value]
+    return args
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))